@@ -0,0 +1,196 @@
+import abc
+import hashlib
+import os
+import tempfile
+from typing import Optional
+
+from elasticsearch.exceptions import ConflictError, NotFoundError
+from elasticsearch_dsl import Document, Binary, Long
+
+from auditlog import conf
+
+PREVIEW = 100
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    """
+    Write a file through a temporary file in the same directory, so readers never see partial content.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class Blob(Document):
+    """
+    Content of a large value, stored once and addressed by its hash.
+    """
+    # Binary values are never indexed, they are only kept in `_source`
+    content = Binary()
+    size = Long(index=False)
+
+    class Index:
+        name = conf.BLOB_INDEX_NAME
+
+
+class BlobStore(abc.ABC):
+    """
+    Content-addressed storage for large values of changes.
+    """
+
+    @staticmethod
+    def make_key(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    @abc.abstractmethod
+    def put(self, data: bytes) -> str:
+        """
+        Store the data if it is not stored yet.
+
+        :param data: The content to store.
+        :return: The key the content is addressed by.
+        """
+
+    @abc.abstractmethod
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        :param key: The key returned by :py:meth:`put`.
+        :return: The stored content or `None` if there is no such key.
+        """
+
+
+class FileSystemBlobStore(BlobStore):
+    """
+    Blob store keeping each value in a separate file, meant for tests and local development.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    def put(self, data: bytes) -> str:
+        key = self.make_key(data)
+        path = self._path(key)
+        if not os.path.exists(path):
+            write_atomic(path, data)
+        return key
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+
+class ElasticsearchBlobStore(BlobStore):
+    """
+    Blob store keeping values as documents of a separate index. The index is created with the mapping of
+    :py:class:`Blob` before the first value is stored, so the content is never indexed.
+    """
+
+    def __init__(self):
+        # Keys stored by this process, they don't have to be sent again
+        self._stored = set()
+        self._initialized = False
+
+    def init_index(self) -> None:
+        """
+        Create the blob index, or update its mapping if it exists.
+        """
+        Blob.init()
+        self._initialized = True
+
+    def put(self, data: bytes) -> str:
+        key = self.make_key(data)
+        if key not in self._stored:
+            if not self._initialized:
+                self.init_index()
+            try:
+                Blob(meta={'id': key}, content=data, size=len(data)).save(op_type='create')
+            except ConflictError:
+                # Same content is already stored
+                pass
+            self._stored.add(key)
+        return key
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            return Blob.get(id=key).content
+        except NotFoundError:
+            return None
+
+
+_blob_store = None
+
+
+def get_blob_store() -> BlobStore:
+    global _blob_store
+    if _blob_store is None:
+        if conf.BLOB_STORE == 'filesystem':
+            if not conf.BLOB_PATH:
+                raise ValueError("Set AUDITLOG_BLOB_PATH as environment variable.")
+            _blob_store = FileSystemBlobStore(conf.BLOB_PATH)
+        elif conf.BLOB_STORE == 'elasticsearch':
+            _blob_store = ElasticsearchBlobStore()
+        else:
+            raise ValueError(f"Unknown blob store `{conf.BLOB_STORE}`")
+    return _blob_store
+
+
+def set_blob_store(store: Optional[BlobStore]) -> None:
+    global _blob_store
+    _blob_store = store
+
+
+def externalize_changes(changes: list, threshold: int = None) -> list:
+    """
+    Move values larger than the threshold to the blob store.
+    The change keeps only a short preview of such value together with its hash and size.
+
+    :param changes: List of changes as returned by :py:func:`auditlog.diff.model_instance_diff`.
+    :param threshold: Size in bytes, defaults to `AUDITLOG_BLOB_THRESHOLD`.
+    :return: New list of changes, the given list is not modified.
+    """
+    threshold = conf.BLOB_THRESHOLD if threshold is None else threshold
+    result = []
+    for change in changes:
+        change = dict(change)
+        for name in ('old', 'new'):
+            value = change.get(name)
+            if value is None:
+                continue
+            data = value.encode('utf-8')
+            if len(data) > threshold:
+                change[name] = value[:PREVIEW]
+                change[f'{name}_hash'] = get_blob_store().put(data)
+                change[f'{name}_size'] = len(data)
+        result.append(change)
+    return result
+
+
+def resolve_value(change, name: str) -> Optional[str]:
+    """
+    Get the full value of a change, loading it from the blob store if it was externalized.
+
+    :param change: The change, either a dictionary or :py:class:`auditlog.documents.Change`.
+    :param name: `old` or `new`.
+    :return: The full value.
+    """
+    if not isinstance(change, dict):
+        change = change.to_dict()
+    key = change.get(f'{name}_hash')
+    if key:
+        data = get_blob_store().get(key)
+        if data is not None:
+            return data.decode('utf-8')
+    return change.get(name)
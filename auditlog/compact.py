@@ -0,0 +1,359 @@
+"""
+Compact binary encoding of changes for models registered with `compact=True`.
+
+The changes of an entry are packed into a single value: a format byte, a bitmap of the changed fields and the
+old and new value of each changed field in the order of the bitmap. The position of a field is its position in
+the audit plan of the model, identified by the schema version stored with the entry. The field order of each
+schema version is kept in a schema store, so entries can be decoded after the registration of the model changes.
+"""
+import abc
+import base64
+import json
+import logging
+import os
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from elasticsearch.exceptions import ConflictError, NotFoundError
+from elasticsearch_dsl import Document, Keyword
+
+from auditlog import conf
+from auditlog.blobs import write_atomic
+
+FORMAT = 1
+
+# Tags of packed values
+NONE = 0
+TEXT = 1
+LIST = 2
+BLOB = 3
+
+
+class Schema(Document):
+    """
+    Field order of a schema version, the id of the document is the version.
+    """
+    fields = Keyword(multi=True, index=False)
+
+    class Index:
+        name = conf.SCHEMA_INDEX_NAME
+
+
+class SchemaStore(abc.ABC):
+    """
+    Storage of the field orders of schema versions.
+    """
+
+    def __init__(self):
+        # Versions already put by this process, the store is asked only once per version
+        self._stored = set()
+
+    def put(self, version: str, fields: Sequence[str]) -> None:
+        """
+        Store the field order of a schema version if it is not stored yet.
+        """
+        if version not in self._stored:
+            self._put(version, tuple(fields))
+            self._stored.add(version)
+
+    @abc.abstractmethod
+    def _put(self, version: str, fields: Tuple[str, ...]) -> None:
+        pass
+
+    @abc.abstractmethod
+    def get(self, version: str) -> Optional[Tuple[str, ...]]:
+        """
+        :return: The field order or `None` if the version is not stored.
+        """
+
+
+class MemorySchemaStore(SchemaStore):
+    """
+    Keeps schemas in memory, meant for tests and sinks that are not read back.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._schemas = {}
+
+    def _put(self, version: str, fields: Tuple[str, ...]) -> None:
+        self._schemas[version] = fields
+
+    def get(self, version: str) -> Optional[Tuple[str, ...]]:
+        return self._schemas.get(version)
+
+
+class FileSystemSchemaStore(SchemaStore):
+    """
+    Keeps each schema in a JSON file named by its version.
+    """
+
+    def __init__(self, root: str):
+        super().__init__()
+        self.root = root
+
+    def _path(self, version: str) -> str:
+        return os.path.join(self.root, f'{version}.json')
+
+    def _put(self, version: str, fields: Tuple[str, ...]) -> None:
+        path = self._path(version)
+        if not os.path.exists(path):
+            write_atomic(path, json.dumps(list(fields)).encode('utf-8'))
+
+    def get(self, version: str) -> Optional[Tuple[str, ...]]:
+        try:
+            with open(self._path(version), encoding='utf-8') as f:
+                return tuple(json.load(f))
+        except FileNotFoundError:
+            return None
+
+
+class ElasticsearchSchemaStore(SchemaStore):
+    """
+    Keeps schemas as documents of a separate index, created with the mapping of :py:class:`Schema`.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._initialized = False
+
+    def _put(self, version: str, fields: Tuple[str, ...]) -> None:
+        if not self._initialized:
+            Schema.init()
+            self._initialized = True
+        try:
+            Schema(meta={'id': version}, fields=list(fields)).save(op_type='create')
+        except ConflictError:
+            # Versions are digests of the fields, the stored schema is the same
+            pass
+
+    def get(self, version: str) -> Optional[Tuple[str, ...]]:
+        try:
+            return tuple(Schema.get(id=version).fields)
+        except NotFoundError:
+            return None
+
+
+_schema_store = None
+
+
+def get_schema_store() -> SchemaStore:
+    global _schema_store
+    if _schema_store is None:
+        if conf.SCHEMA_STORE == 'memory':
+            _schema_store = MemorySchemaStore()
+        elif conf.SCHEMA_STORE == 'filesystem':
+            if not conf.SCHEMA_PATH:
+                raise ValueError("Set AUDITLOG_SCHEMA_PATH as environment variable.")
+            _schema_store = FileSystemSchemaStore(conf.SCHEMA_PATH)
+        elif conf.SCHEMA_STORE == 'elasticsearch':
+            _schema_store = ElasticsearchSchemaStore()
+        else:
+            raise ValueError(f"Unknown schema store `{conf.SCHEMA_STORE}`")
+    return _schema_store
+
+
+def set_schema_store(store: Optional[SchemaStore]) -> None:
+    global _schema_store
+    _schema_store = store
+
+
+@lru_cache(maxsize=128)
+def _field_index(fields: Tuple[str, ...]) -> Dict[str, int]:
+    return {field: i for i, field in enumerate(fields)}
+
+
+def _write_varint(out: bytearray, value: int) -> None:
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _write_text(out: bytearray, value: str) -> None:
+    data = value.encode('utf-8')
+    _write_varint(out, len(data))
+    out += data
+
+
+def _read_text(data: bytes, pos: int) -> Tuple[str, int]:
+    size, pos = _read_varint(data, pos)
+    return data[pos:pos + size].decode('utf-8'), pos + size
+
+
+def _write_value(out: bytearray, change: dict, name: str) -> None:
+    value = change.get(name)
+    key = change.get(f'{name}_hash')
+    if key:
+        # Value moved to the blob store, keep the preview and the reference
+        out.append(BLOB)
+        _write_text(out, value or '')
+        _write_text(out, key)
+        _write_varint(out, change.get(f'{name}_size') or 0)
+    elif value is None:
+        out.append(NONE)
+    else:
+        out.append(TEXT)
+        _write_text(out, str(value))
+
+
+def _read_value(data: bytes, pos: int, change: dict, name: str) -> int:
+    tag = data[pos]
+    pos += 1
+    if tag == NONE:
+        change[name] = None
+    elif tag == TEXT:
+        change[name], pos = _read_text(data, pos)
+    elif tag == BLOB:
+        change[name], pos = _read_text(data, pos)
+        change[f'{name}_hash'], pos = _read_text(data, pos)
+        change[f'{name}_size'], pos = _read_varint(data, pos)
+    else:
+        raise ValueError(f"Unknown value tag {tag} at position {pos - 1}")
+    return pos
+
+
+def _write_list(out: bytearray, values: Sequence[str]) -> None:
+    out.append(LIST)
+    _write_varint(out, len(values))
+    for value in values:
+        _write_text(out, str(value))
+
+
+def _read_list(data: bytes, pos: int) -> Tuple[List[str], int]:
+    if data[pos] != LIST:
+        raise ValueError(f"Expected a list at position {pos}")
+    count, pos = _read_varint(data, pos + 1)
+    values = []
+    for _ in range(count):
+        value, pos = _read_text(data, pos)
+        values.append(value)
+    return values, pos
+
+
+def encode_changes(changes: list, fields: Sequence[str]) -> bytes:
+    """
+    Pack a list of changes.
+
+    :param changes: List of changes as returned by :py:func:`auditlog.diff.model_instance_diff`.
+    :param fields: The fields of the schema, in order.
+    :return: The packed changes.
+    """
+    index = _field_index(tuple(fields))
+    by_position = {}
+    for change in changes:
+        try:
+            by_position[index[change['field']]] = change
+        except KeyError:
+            raise ValueError(f"Field `{change['field']}` is not part of the schema") from None
+
+    bitmap = 0
+    for position in by_position:
+        bitmap |= 1 << position
+    out = bytearray([FORMAT])
+    out += bitmap.to_bytes((len(fields) + 7) // 8, 'little')
+    for position in sorted(by_position):
+        change = by_position[position]
+        if 'added' in change or 'removed' in change:
+            _write_list(out, change.get('removed') or [])
+            _write_list(out, change.get('added') or [])
+        else:
+            _write_value(out, change, 'old')
+            _write_value(out, change, 'new')
+    return bytes(out)
+
+
+def decode_changes(data: bytes, fields: Sequence[str]) -> list:
+    """
+    Restore the list of changes packed by :py:func:`encode_changes`.
+
+    :param data: The packed changes.
+    :param fields: The fields of the schema the changes were packed with.
+    :return: List of changes in the same form as before packing, ordered as the fields of the schema.
+    """
+    if not data:
+        return []
+    if data[0] != FORMAT:
+        raise ValueError(f"Unknown format {data[0]} of packed changes")
+    size = (len(fields) + 7) // 8
+    bitmap = int.from_bytes(data[1:1 + size], 'little')
+    pos = 1 + size
+    changes = []
+    for position, field in enumerate(fields):
+        if not bitmap >> position & 1:
+            continue
+        change = {'field': field}
+        if data[pos] == LIST:
+            change['removed'], pos = _read_list(data, pos)
+            change['added'], pos = _read_list(data, pos)
+        else:
+            pos = _read_value(data, pos, change, 'old')
+            pos = _read_value(data, pos, change, 'new')
+        changes.append(change)
+    return changes
+
+
+def encode_entry(kwargs: dict) -> dict:
+    """
+    Replace the changes of a log entry by the packed changes and the names of the changed fields.
+
+    The schema is stored before the first entry using it, if that fails the changes are kept unpacked,
+    so an entry is never written without a way to decode it.
+
+    :param kwargs: Field values of the log entry with `schema_version` set.
+    :return: New field values, the given dictionary is not modified.
+    """
+    from auditlog.registry import auditlog
+
+    fields = auditlog.get_schema(kwargs['schema_version'])
+    try:
+        get_schema_store().put(kwargs['schema_version'], fields)
+    except Exception:
+        logging.exception("Error when saving schema of compact changes, changes are not packed")
+        return {name: value for name, value in kwargs.items() if name != 'schema_version'}
+    result = dict(kwargs)
+    changes = result.pop('changes', None) or []
+    result['changes_packed'] = encode_changes(changes, fields)
+    result['change_fields'] = [change['field'] for change in changes]
+    return result
+
+
+def decode_entry(changes_packed: Optional[bytes], schema_version: str) -> list:
+    """
+    Restore the changes of a stored log entry, looking up the fields of its schema in the registry
+    and in the schema store.
+
+    :param changes_packed: The packed changes.
+    :param schema_version: The schema version stored with the entry.
+    """
+    from auditlog.registry import auditlog
+
+    try:
+        fields = auditlog.get_schema(schema_version)
+    except KeyError:
+        raise ValueError(
+            f"Unknown schema `{schema_version}` of packed changes"
+        ) from None
+    return decode_changes(changes_packed, fields)
+
+
+def get_source_changes(source: dict) -> list:
+    """
+    Get the changes of a log entry read as a raw document, e.g. a search hit, unpacking them if needed.
+
+    :param source: The `_source` of the document.
+    """
+    if source.get('schema_version'):
+        return decode_entry(base64.b64decode(source.get('changes_packed') or ''), source['schema_version'])
+    return source.get('changes', [])
@@ -1,8 +1,48 @@
 import os
 
-try:
-    ELASTICSEARCH_HOST = os.environ['AUDITLOG_ELASTICSEARCH_HOST']
-    ELASTICSEARCH_PORT = os.environ['AUDITLOG_ELASTICSEARCH_PORT']
-    INDEX_NAME = os.environ['AUDITLOG_INDEX_NAME']
-except KeyError as e:
-    raise ValueError(f"Set {e} as environment variable.")
+# Where log entries are written, `elasticsearch`, `memory` or `file`
+SINK = os.getenv('AUDITLOG_SINK', 'elasticsearch')
+
+if SINK == 'elasticsearch':
+    try:
+        ELASTICSEARCH_HOST = os.environ['AUDITLOG_ELASTICSEARCH_HOST']
+        ELASTICSEARCH_PORT = os.environ['AUDITLOG_ELASTICSEARCH_PORT']
+        INDEX_NAME = os.environ['AUDITLOG_INDEX_NAME']
+    except KeyError as e:
+        raise ValueError(f"Set {e} as environment variable.")
+else:
+    ELASTICSEARCH_HOST = os.getenv('AUDITLOG_ELASTICSEARCH_HOST')
+    ELASTICSEARCH_PORT = os.getenv('AUDITLOG_ELASTICSEARCH_PORT')
+    INDEX_NAME = os.getenv('AUDITLOG_INDEX_NAME', 'auditlog')
+
+# Number of entries kept by the `memory` sink
+SINK_MEMORY_SIZE = int(os.getenv('AUDITLOG_SINK_MEMORY_SIZE', 10000))
+# NDJSON file the `file` sink appends to
+SINK_PATH = os.getenv('AUDITLOG_SINK_PATH')
+
+# Values larger than this number of bytes are moved to the blob store, 0 disables it
+BLOB_THRESHOLD = int(os.getenv('AUDITLOG_BLOB_THRESHOLD', 0))
+# Blob store backend, `elasticsearch` or `filesystem`
+BLOB_STORE = os.getenv('AUDITLOG_BLOB_STORE', 'elasticsearch')
+BLOB_INDEX_NAME = os.getenv('AUDITLOG_BLOB_INDEX_NAME', f'{INDEX_NAME}-blobs')
+BLOB_PATH = os.getenv('AUDITLOG_BLOB_PATH')
+
+# Flushes taking longer than this number of seconds are logged as a warning, 0 disables it
+SLOW_FLUSH_THRESHOLD = float(os.getenv('AUDITLOG_SLOW_FLUSH_THRESHOLD', 0))
+
+# Activity rollup counters are written in the background every this number of seconds, 0 disables the rollup
+ROLLUP_INTERVAL = float(os.getenv('AUDITLOG_ROLLUP_INTERVAL', 0))
+ROLLUP_INDEX_NAME = os.getenv('AUDITLOG_ROLLUP_INDEX_NAME', f'{INDEX_NAME}-rollup')
+
+# Number of objects whose recent history is cached, 0 disables the cache
+HISTORY_CACHE_SIZE = int(os.getenv('AUDITLOG_HISTORY_CACHE_SIZE', 0))
+# Seconds after which cached history is read from Elasticsearch again
+HISTORY_CACHE_TTL = float(os.getenv('AUDITLOG_HISTORY_CACHE_TTL', 60))
+
+# How log entries of tenants are separated, `none`, `index` (index per tenant) or `routing` (shard routing key)
+TENANT_ROUTING = os.getenv('AUDITLOG_TENANT_ROUTING', 'none')
+
+# Where field orders of compact encoded changes are kept, `elasticsearch`, `filesystem` or `memory`
+SCHEMA_STORE = os.getenv('AUDITLOG_SCHEMA_STORE', 'elasticsearch' if SINK == 'elasticsearch' else 'memory')
+SCHEMA_INDEX_NAME = os.getenv('AUDITLOG_SCHEMA_INDEX_NAME', f'{INDEX_NAME}-schemas')
+SCHEMA_PATH = os.getenv('AUDITLOG_SCHEMA_PATH')
@@ -26,3 +26,19 @@ def set_remote_addr(remote_addr: str) -> Token:
 
 def remove_remote_addr(token: Token) -> None:
     _remote_addr_ctx_var.reset(token)
+
+
+TENANT_CTX_KEY = "tenant"
+_tenant_ctx_var: ContextVar[str] = ContextVar(TENANT_CTX_KEY, default=None)
+
+
+def get_tenant() -> str:
+    return _tenant_ctx_var.get()
+
+
+def set_tenant(tenant: str) -> Token:
+    return _tenant_ctx_var.set(tenant)
+
+
+def remove_tenant(token: Token) -> None:
+    _tenant_ctx_var.reset(token)
@@ -1,23 +1,27 @@
 import weakref
-from typing import Any, List
+from datetime import datetime
+from typing import Any, Iterable, List
 
 from sqlalchemy import inspect
-from sqlalchemy.orm import object_mapper, ColumnProperty
+from sqlalchemy.orm import class_mapper, ColumnProperty
+from sqlalchemy.orm.attributes import PASSIVE_NO_INITIALIZE
 
+from auditlog.context import get_remote_addr
 from auditlog.documents import log_entry_class
 
 
-def get_fields_in_model(instance: Any) -> List:
+def get_fields_in_mapper(mapper: Any, model: Any) -> Iterable:
     """
-    Returns the list of fields in the given model instance.
+    Returns the properties of the mapper tracked for the given model.
 
-    :param instance: The model instance to get the fields for
-    :return: The list of fields for the given model (instance)
+    :param mapper: The mapper of the model
+    :param model: The registered model
+    :return: The tracked properties
     """
     from auditlog.registry import auditlog
 
-    attrs = object_mapper(instance).iterate_properties
-    model_attrs = auditlog.get_model_fields(instance.__class__)
+    attrs = mapper.iterate_properties
+    model_attrs = auditlog.get_model_fields(model)
     if model_attrs['include_fields']:
         attrs = (attr for attr in attrs if attr.key in model_attrs['include_fields'])
     if model_attrs['exclude_fields']:
@@ -26,41 +30,160 @@ def get_fields_in_model(instance: Any) -> List:
     return attrs
 
 
+def get_audited_column_keys(model: Any) -> List[str]:
+    """
+    Returns keys of the column attributes tracked for the given model.
+    """
+    return [
+        mapper_property.key for mapper_property in get_fields_in_mapper(class_mapper(model), model)
+        if isinstance(mapper_property, ColumnProperty)
+    ]
+
+
+def get_related_pk(obj: Any) -> str:
+    """
+    Returns the primary key of a related object without loading any attribute.
+    """
+    state = inspect(obj)
+    if state.key:
+        identity = state.key[1]
+    else:
+        identity = [
+            state.dict.get(state.mapper.get_property_by_column(column).key) for column in state.mapper.primary_key
+        ]
+    return ','.join(str(value) for value in identity)
+
+
 def model_instance_diff(obj: Any):
     """
     Find difference between two model instances.
     :param obj: changed model instance
     :return: List of dictionary with old and new values
     """
+    from auditlog.registry import auditlog
+
+    return instance_diff(obj, auditlog.get_audit_plan(obj.__class__))
+
+
+def instance_diff(obj: Any, plan: Any) -> list:
+    """
+    Find changes of the attributes in the audit plan.
+    :param obj: changed model instance
+    :param plan: audit plan of the model, see :py:meth:`AuditlogModelRegistry.get_audit_plan`
+    :return: List of dictionary with old and new values
+    """
     diff = []
-    for mapper_property in get_fields_in_model(obj):
-        if isinstance(mapper_property, ColumnProperty):
-            key = mapper_property.key
-            attribute_state = inspect(obj).attrs.get(key)
-            history = attribute_state.history
-            if history.has_changes():
-                diff.append({
-                    'field': key,
-                    'old': str(history.deleted[0]) if history.deleted else None,
-                    'new': str(attribute_state.value)
-                })
+    state = inspect(obj)
+    for key in plan.columns:
+        # Same as `state.attrs[key].history`, without creating the attribute state
+        history = state.get_history(key, PASSIVE_NO_INITIALIZE)
+        if history.has_changes():
+            diff.append({
+                'field': key,
+                'old': str(history.deleted[0]) if history.deleted else None,
+                'new': str(history.added[0] if history.added else state.attrs[key].value)
+            })
+    for key in plan.relationships:
+        # History of an unloaded relationship contains only changes held in memory, nothing is loaded
+        history = state.get_history(key, PASSIVE_NO_INITIALIZE)
+        if history.added or history.deleted:
+            diff.append({
+                'field': key,
+                'added': [get_related_pk(related) for related in history.added if related is not None],
+                'removed': [get_related_pk(related) for related in history.deleted if related is not None],
+            })
     return diff
 
 
 def set_entry_attributes(
     obj: Any, action: log_entry_class().Action, entry_attrs: list, user_ref: weakref.ref
 ) -> None:
+    set_entries_attributes([obj], action, entry_attrs, user_ref, datetime.now())
+
+
+def set_entries_attributes(
+    objects: Iterable[Any], action: log_entry_class().Action, entry_attrs: list, user_ref: weakref.ref,
+    timestamp: datetime,
+) -> None:
+    """
+    Create log entries of flushed objects. Objects are grouped by their class first,
+    so lookups of the registry and of the audit plan are done once per class instead of once per object.
+
+    :param objects: Flushed instances
+    :param action: Action of all the instances
+    :param entry_attrs: List the entries are appended to
+    :param user_ref: Reference to the current user
+    :param timestamp: Timestamp of all the entries
+    """
+    from auditlog.registry import auditlog
+
+    groups = {}
+    for obj in objects:
+        groups.setdefault(obj.__class__, []).append(obj)
+
+    entry_class = log_entry_class()
+    is_delete = action == entry_class.Action.DELETE
+    user_fields = {}
+    if user_ref and user_ref():
+        entry_class.set_user_fields(user_ref(), user_fields)
+    remote_addr = get_remote_addr()
+    for model, instances in groups.items():
+        if not auditlog.contains(model):
+            continue
+        plan = auditlog.get_audit_plan(model)
+        for obj in instances:
+            changes = instance_diff(obj, plan)
+            if changes or is_delete:
+                # create log entry only if there are any changes in tracked fields
+                kwargs = entry_class.get_fields(
+                    obj,
+                    action=action,
+                    changes=changes,
+                    timestamp=timestamp,
+                    remote_addr=remote_addr,
+                )
+                for name, value in user_fields.items():
+                    kwargs.setdefault(name, value)
+                entry_attrs.append(kwargs)
+
+
+def set_mapping_entry_attributes(
+    model: Any, action: log_entry_class().Action, mappings: List[dict], entry_attrs: list, user_ref: weakref.ref
+) -> None:
+    """
+    Create log entries from dictionaries passed to bulk operations, without instantiating the model.
+    Old values of updated fields are not known, they are logged as `None`.
+
+    :param model: The registered model
+    :param action: Action of all the mappings
+    :param mappings: Dictionaries of attribute values, updated mappings contain the primary key
+    :param entry_attrs: List the entries are appended to
+    :param user_ref: Reference to the current user
+    """
     from auditlog.registry import auditlog
 
-    if auditlog.contains(obj.__class__):
-        changes = model_instance_diff(obj)
-        if changes or action == log_entry_class().Action.DELETE:
-            # create log entry only if there are any changes in tracked fields
-            kwargs = log_entry_class().get_fields(
-                obj,
+    entry_class = log_entry_class()
+    keys = auditlog.get_audit_plan(model).columns
+    pk_keys = {class_mapper(model).get_property_by_column(column).key for column in model.__table__.primary_key}
+    if action == entry_class.Action.UPDATE:
+        keys = [key for key in keys if key not in pk_keys]
+    user_fields = {}
+    if user_ref and user_ref():
+        entry_class.set_user_fields(user_ref(), user_fields)
+    timestamp = datetime.now()
+    for mapping in mappings:
+        changes = [
+            {'field': key, 'old': None, 'new': str(mapping[key])}
+            for key in keys if key in mapping
+        ]
+        if changes or action == entry_class.Action.DELETE:
+            kwargs = entry_class.get_mapping_fields(
+                model,
+                mapping,
                 action=action,
                 changes=changes,
+                timestamp=timestamp,
             )
-            if user_ref and user_ref():
-                log_entry_class().set_user_fields(user_ref(), kwargs)
+            for name, value in user_fields.items():
+                kwargs.setdefault(name, value)
             entry_attrs.append(kwargs)
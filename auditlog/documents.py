@@ -1,14 +1,23 @@
+import hashlib
 import logging
 from datetime import datetime
 from typing import Any, Optional
 
-from elasticsearch_dsl import Document, connections, Keyword, Date, Nested, InnerDoc, Text
+from elasticsearch.exceptions import ConflictError
+from elasticsearch_dsl import Document, connections, Keyword, Date, Nested, InnerDoc, Text, Integer, Long, Binary
+from sqlalchemy.orm import class_mapper
 
 from auditlog import conf
+from auditlog.blobs import externalize_changes
+from auditlog.compact import decode_entry, encode_entry
 from auditlog.context import get_remote_addr
+from auditlog.metrics import get_metrics
+from auditlog.routing import get_route, resolve_tenant
+from auditlog.sinks import get_sink
 
 # Define a default Elasticsearch client
-connections.create_connection(hosts=[conf.ELASTICSEARCH_HOST])
+if conf.ELASTICSEARCH_HOST:
+    connections.create_connection(hosts=[conf.ELASTICSEARCH_HOST])
 
 MAX = 75
 
@@ -17,6 +26,14 @@ class Change(InnerDoc):
     field = Keyword(required=True)
     old = Text()
     new = Text()
+    # Set when the value was moved to the blob store, `old` and `new` keep only a preview then
+    old_hash = Keyword()
+    old_size = Long()
+    new_hash = Keyword()
+    new_size = Long()
+    # Primary keys of objects added to and removed from a relationship
+    added = Keyword(multi=True)
+    removed = Keyword(multi=True)
 
 
 class LogEntry(Document):
@@ -46,10 +63,20 @@ class LogEntry(Document):
 
     remote_addr = Text()
 
+    tenant = Keyword()
+
     timestamp = Date(required=True)
 
+    transaction_id = Keyword()
+    sequence = Integer()
+
     changes = Nested(Change)
 
+    # Set instead of `changes` for models registered with `compact=True`, see :py:mod:`auditlog.compact`
+    schema_version = Keyword()
+    changes_packed = Binary()
+    change_fields = Keyword(multi=True)
+
     class Index:
         name = conf.INDEX_NAME
 
@@ -65,13 +92,24 @@ class LogEntry(Document):
     def changed_fields(self):
         if self.action == LogEntry.Action.DELETE:
             return ''  # delete
-        changes = self.changes
-        s = '' if len(changes) == 1 else 's'
-        fields = ', '.join(change['field'] for change in changes)
+        if self.schema_version:
+            names = list(self.change_fields or [])
+        else:
+            names = [change['field'] for change in self.changes]
+        s = '' if len(names) == 1 else 's'
+        fields = ', '.join(names)
         if len(fields) > MAX:
             i = fields.rfind(' ', 0, MAX)
             fields = fields[:i] + ' ..'
-        return '%d change%s: %s' % (len(changes), s, fields)
+        return '%d change%s: %s' % (len(names), s, fields)
+
+    def get_changes(self) -> list:
+        """
+        Returns the changes as a list of dictionaries, unpacking them if the entry is compact encoded.
+        """
+        if self.schema_version:
+            return decode_entry(self.changes_packed, self.schema_version)
+        return [change.to_dict() if isinstance(change, InnerDoc) else change for change in self.changes or []]
 
     def __str__(self):
         if self.action == self.Action.CREATE:
@@ -88,25 +126,65 @@ class LogEntry(Document):
     @classmethod
     def log_create(cls, kwargs) -> Optional['LogEntry']:
         """
-        Helper method to create a new log entry.
+        Helper method to create a new log entry and write it to the configured sink.
         :param kwargs: Field overrides for the :py:class:`LogEntry` object.
         :return: The new log entry or `None` if there were no changes.
         :rtype: LogEntry
         """
         if kwargs is not None:
-            log_entry = cls(**kwargs)
-            log_entry.save()
+            if conf.BLOB_THRESHOLD and kwargs.get('changes'):
+                kwargs = dict(kwargs, changes=externalize_changes(kwargs['changes']))
+            if kwargs.get('schema_version'):
+                kwargs = encode_entry(kwargs)
+            document_id = cls.get_document_id(kwargs)
+            # The model is captured only to dispatch the entry to subscribers, it is not a field
+            fields = {name: value for name, value in kwargs.items() if name != '_model'}
+            log_entry = cls(meta={'id': document_id} if document_id else None, **fields)
+            get_sink().write(log_entry)
             return log_entry
         return None
 
+    @classmethod
+    def get_document_id(cls, kwargs) -> Optional[str]:
+        """
+        Build a deterministic document id for the log entry, so that retrying the same entry
+        never creates a duplicate document.
+        :param kwargs: Field values of the log entry.
+        :return: The document id or `None` if the entry is not bound to a transaction.
+        """
+        if kwargs.get('transaction_id') is None:
+            return None
+        key = ':'.join(str(kwargs.get(name)) for name in (
+            'transaction_id', 'table_name', 'object_pk', 'action', 'sequence'
+        ))
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get_route(self):
+        return get_route(self.tenant)
+
     def save(self, using=None, index=None, validate=True, skip_empty=True, **kwargs):
+        # Entries are immutable, `create` makes retries with the same id idempotent
+        kwargs.setdefault('op_type', 'create')
+        if index is None:
+            route = self.get_route()
+            index = route.index
+            if route.routing:
+                kwargs.setdefault('routing', route.routing)
         try:
-            return super().save(using, index, validate, skip_empty, **kwargs)
+            result = super().save(using, index, validate, skip_empty, **kwargs)
+        except ConflictError:
+            # Document with the same id already exists, it was saved by a previous attempt
+            get_metrics().entry_saved(self)
+            return 'noop'
         except Exception:
+            get_metrics().entry_failed(self)
             logging.exception(
                 "Error when saving log to elasticsearch",
                 extra={'log_entry': self.to_dict()}
             )
+        else:
+            get_metrics().entry_saved(self)
+            return result
 
     @classmethod
     def _get_pk_value(cls, instance: Any):
@@ -117,8 +195,26 @@ class LogEntry(Document):
         :type instance: Model
         :return: The primary key value of the given model instance.
         """
-        name = instance.__table__.primary_key.columns.values()[0].name
-        return getattr(instance, name)
+        return getattr(instance, cls._get_pk_key(instance.__class__))
+
+    @classmethod
+    def _get_pk_key(cls, model: Any) -> str:
+        """
+        Get the attribute key of the primary key column, which may differ from the column name.
+        """
+        mapper = class_mapper(model)
+        return mapper.get_property_by_column(mapper.primary_key[0]).key
+
+    @classmethod
+    def _get_schema_version(cls, model: Any) -> Optional[str]:
+        """
+        Get the compact encoding schema of a model, `None` if the model is not registered with `compact=True`.
+        """
+        from auditlog.registry import auditlog
+
+        if not auditlog.contains(model):
+            return None
+        return auditlog.get_audit_plan(model).schema_version
 
     @classmethod
     def get_fields(cls, instance: Any, **kwargs) -> Optional[dict]:
@@ -126,11 +222,40 @@ class LogEntry(Document):
         pk = cls._get_pk_value(instance)
 
         if changes is not None:
-            kwargs.setdefault('object_pk', str(pk))
+            kwargs.setdefault('object_pk', str(pk) if pk is not None else None)
             kwargs.setdefault('object_repr', str(instance))
             kwargs.setdefault('timestamp', datetime.now())
             kwargs.setdefault('table_name', instance.__tablename__)
+            kwargs.setdefault('_model', instance.__class__)
+            kwargs.setdefault('remote_addr', get_remote_addr())
+            kwargs.setdefault('tenant', resolve_tenant(instance))
+            schema_version = cls._get_schema_version(instance.__class__)
+            if schema_version:
+                kwargs.setdefault('schema_version', schema_version)
+            if isinstance(pk, int):
+                kwargs.setdefault('object_id', pk)
+            return kwargs
+        return None
+
+    @classmethod
+    def get_mapping_fields(cls, model: Any, mapping: dict, **kwargs) -> Optional[dict]:
+        """
+        Same as :py:meth:`get_fields` for dictionaries of attribute values used by bulk operations.
+        """
+        changes = kwargs.get('changes', None)
+        pk = mapping.get(cls._get_pk_key(model))
+
+        if changes is not None:
+            kwargs.setdefault('object_pk', str(pk) if pk is not None else None)
+            kwargs.setdefault('object_repr', f'{model.__name__}: {pk}')
+            kwargs.setdefault('timestamp', datetime.now())
+            kwargs.setdefault('table_name', model.__tablename__)
+            kwargs.setdefault('_model', model)
             kwargs.setdefault('remote_addr', get_remote_addr())
+            kwargs.setdefault('tenant', resolve_tenant(None))
+            schema_version = cls._get_schema_version(model)
+            if schema_version:
+                kwargs.setdefault('schema_version', schema_version)
             if isinstance(pk, int):
                 kwargs.setdefault('object_id', pk)
             return kwargs
@@ -0,0 +1,269 @@
+"""
+Streaming export of log entries to files partitioned by table and date::
+
+    python -m auditlog.export /data/auditlog --since 2021-01-01 --until 2021-04-01 --format parquet
+
+Entries are read page by page through a point in time (Elasticsearch 7.12+) and written as
+``<directory>/table_name=<table>/date=<yyyy-mm-dd>/part-<n>.<ext>``, so memory use does not depend on
+the number of exported entries. Parquet files require `pyarrow`.
+"""
+import abc
+import argparse
+import gzip
+import json
+import os
+from collections import OrderedDict
+from datetime import datetime
+from typing import Iterator, List, Optional, Tuple
+
+from elasticsearch_dsl import connections
+
+from auditlog.compact import get_source_changes
+from auditlog.routing import get_route, get_search_index
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+FORMATS = ('ndjson', 'parquet')
+COLUMNS = (
+    'action', 'table_name', 'object_id', 'object_pk', 'object_repr', 'actor_id', 'actor_email',
+    'actor_first_name', 'actor_last_name', 'remote_addr', 'timestamp', 'transaction_id', 'sequence',
+)
+
+Partition = Tuple[str, str]
+
+
+def get_partition(source: dict) -> Partition:
+    return source.get('table_name') or 'unknown', (source.get('timestamp') or 'unknown')[:10]
+
+
+class PartitionWriter(abc.ABC):
+    """
+    Writes log entries to files of their partition.
+    """
+    extension = None
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._parts = {}
+
+    def _next_path(self, partition: Partition) -> str:
+        table_name, date = partition
+        directory = os.path.join(self.directory, f'table_name={table_name}', f'date={date}')
+        os.makedirs(directory, exist_ok=True)
+        part = self._parts.get(partition, 0)
+        self._parts[partition] = part + 1
+        return os.path.join(directory, f'part-{part:05d}.{self.extension}')
+
+    @abc.abstractmethod
+    def write(self, hit: dict) -> None:
+        """
+        Write a search hit to the file of its partition.
+        """
+
+    @abc.abstractmethod
+    def close(self) -> None:
+        """
+        Write buffered entries and close all files.
+        """
+
+    def __enter__(self) -> 'PartitionWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class NDJSONPartitionWriter(PartitionWriter):
+    """
+    Writes gzip compressed NDJSON, one document per line. At most `max_open` files are kept open.
+    """
+    extension = 'ndjson.gz'
+
+    def __init__(self, directory: str, max_open: int = 32):
+        super().__init__(directory)
+        self.max_open = max_open
+        self._paths = {}
+        self._files = OrderedDict()
+
+    def _get_file(self, partition: Partition):
+        f = self._files.get(partition)
+        if f is not None:
+            self._files.move_to_end(partition)
+            return f
+        if len(self._files) >= self.max_open:
+            _, oldest = self._files.popitem(last=False)
+            oldest.close()
+        if partition in self._paths:
+            # Appending adds a new gzip member, the file stays a valid gzip file
+            mode = 'at'
+        else:
+            self._paths[partition] = self._next_path(partition)
+            mode = 'wt'
+        f = self._files[partition] = gzip.open(self._paths[partition], mode, encoding='utf-8')
+        return f
+
+    def write(self, hit: dict) -> None:
+        source = dict(hit['_source'], id=hit['_id'])
+        if source.get('schema_version'):
+            # Compact entries are exported unpacked, files don't depend on the schema store
+            source['changes'] = get_source_changes(source)
+            del source['schema_version']
+            source.pop('changes_packed', None)
+        self._get_file(get_partition(source)).write(json.dumps(source, separators=(',', ':')) + '\n')
+
+    def close(self) -> None:
+        while self._files:
+            _, f = self._files.popitem()
+            f.close()
+
+
+class ParquetPartitionWriter(PartitionWriter):
+    """
+    Writes Parquet files with string columns, changes are stored as a JSON string.
+    A new part file is written whenever a partition collects `batch_size` entries,
+    or when all partitions together hold `max_buffered` entries.
+    """
+    extension = 'parquet'
+
+    def __init__(self, directory: str, batch_size: int = 50000, max_buffered: int = 200000):
+        if pyarrow is None:
+            raise ImportError("Install `pyarrow` to export Parquet files")
+        super().__init__(directory)
+        self.batch_size = batch_size
+        self.max_buffered = max_buffered
+        self.schema = pyarrow.schema([(name, pyarrow.string()) for name in ('id',) + COLUMNS + ('changes',)])
+        self._buffers = {}
+        self._buffered = 0
+
+    def _flush(self, partition: Partition) -> None:
+        rows = self._buffers.pop(partition)
+        self._buffered -= len(rows)
+        table = pyarrow.Table.from_pylist(rows, schema=self.schema)
+        pyarrow.parquet.write_table(table, self._next_path(partition), compression='zstd')
+
+    def write(self, hit: dict) -> None:
+        source = hit['_source']
+        row = {name: None if source.get(name) is None else str(source[name]) for name in COLUMNS}
+        row['id'] = hit['_id']
+        row['changes'] = json.dumps(get_source_changes(source), separators=(',', ':'))
+        partition = get_partition(source)
+        rows = self._buffers.setdefault(partition, [])
+        rows.append(row)
+        self._buffered += 1
+        if len(rows) >= self.batch_size:
+            self._flush(partition)
+        elif self._buffered >= self.max_buffered:
+            self._flush(max(self._buffers, key=lambda key: len(self._buffers[key])))
+
+    def close(self) -> None:
+        for partition in list(self._buffers):
+            self._flush(partition)
+
+
+def iter_hits(
+    index: str, query: dict, page_size: int = 5000, keep_alive: str = '5m', using: str = 'default',
+    routing: Optional[str] = None,
+) -> Iterator[dict]:
+    """
+    Yield raw hits matching the query, sorted by timestamp, using a point in time and `search_after`.
+    """
+    es = connections.get_connection(using)
+    params = {'keep_alive': keep_alive}
+    if routing:
+        params['routing'] = routing
+    pit_id = es.open_point_in_time(index=index, params=params)['id']
+    body = {
+        'size': page_size,
+        'query': query,
+        'pit': {'id': pit_id, 'keep_alive': keep_alive},
+        'sort': [{'timestamp': 'asc'}, {'_shard_doc': 'asc'}],
+        'track_total_hits': False,
+    }
+    try:
+        while True:
+            response = es.search(body=body)
+            hits = response['hits']['hits']
+            if not hits:
+                return
+            yield from hits
+            body['search_after'] = hits[-1]['sort']
+            body['pit']['id'] = response.get('pit_id', body['pit']['id'])
+    finally:
+        es.close_point_in_time(body={'id': body['pit']['id']})
+
+
+def build_query(
+    since: Optional[datetime] = None, until: Optional[datetime] = None, tables: Optional[List[str]] = None,
+    tenant: Optional[str] = None,
+) -> dict:
+    filters = []
+    if since or until:
+        time_range = {}
+        if since:
+            time_range['gte'] = since.isoformat()
+        if until:
+            time_range['lt'] = until.isoformat()
+        filters.append({'range': {'timestamp': time_range}})
+    if tables:
+        filters.append({'terms': {'table_name': tables}})
+    if tenant:
+        filters.append({'term': {'tenant': tenant}})
+    return {'bool': {'filter': filters}}
+
+
+def export(
+    directory: str, since: Optional[datetime] = None, until: Optional[datetime] = None,
+    tables: Optional[List[str]] = None, format: str = 'ndjson', index: Optional[str] = None,
+    page_size: int = 5000, tenant: Optional[str] = None,
+) -> int:
+    """
+    Export log entries to files partitioned by table and date.
+
+    :param directory: Directory to write the files to.
+    :param since: Export entries from this time, inclusive.
+    :param until: Export entries up to this time, exclusive.
+    :param tables: Export only entries of these tables.
+    :param format: `ndjson` or `parquet`.
+    :param index: Index to read from, defaults to the indices of the tenant.
+    :param page_size: Number of entries read at once.
+    :param tenant: Export only entries of this tenant, entries of all tenants are exported by default.
+    :return: Number of exported entries.
+    """
+    if format not in FORMATS:
+        raise ValueError(f"Unknown format `{format}`")
+    if index is None:
+        index = get_search_index(tenant)
+    routing = get_route(tenant).routing if tenant else None
+    writer_class = NDJSONPartitionWriter if format == 'ndjson' else ParquetPartitionWriter
+    count = 0
+    with writer_class(directory) as writer:
+        for hit in iter_hits(index, build_query(since, until, tables, tenant), page_size, routing=routing):
+            writer.write(hit)
+            count += 1
+    return count
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory', help='directory to write the files to')
+    parser.add_argument('--since', type=datetime.fromisoformat, help='ISO date or datetime, inclusive')
+    parser.add_argument('--until', type=datetime.fromisoformat, help='ISO date or datetime, exclusive')
+    parser.add_argument('--table', dest='tables', action='append', help='export only this table, can be repeated')
+    parser.add_argument('--format', choices=FORMATS, default='ndjson')
+    parser.add_argument('--tenant', help='export only this tenant')
+    parser.add_argument('--index', help='index to read from')
+    parser.add_argument('--page-size', type=int, default=5000)
+    args = parser.parse_args(argv)
+
+    count = export(
+        args.directory, args.since, args.until, args.tables, args.format, args.index, args.page_size, args.tenant
+    )
+    print(f"Exported {count} log entries to {args.directory}")
+
+
+if __name__ == '__main__':
+    main()
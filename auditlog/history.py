@@ -0,0 +1,150 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, List, Optional, Tuple
+
+from auditlog import conf, routing
+from auditlog.context import get_tenant
+from auditlog.metrics import get_metrics
+
+HistoryKey = Tuple[Optional[str], str, str]
+
+
+class HistoryCache:
+    """
+    Bounded LRU cache of the most recent log entries of objects, expiring after `ttl` seconds.
+    Entries committed by this process are added to cached histories.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # key -> (expires, limit, complete, entries), entries are sorted from the newest
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'size': len(self._data),
+        }
+
+    def __contains__(self, key: HistoryKey) -> bool:
+        return key in self._data
+
+    def get(self, key: HistoryKey, limit: int) -> Optional[List[Any]]:
+        """
+        :return: Up to `limit` newest entries or `None` if they are not cached.
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                expires, cached_limit, complete, entries = item
+                if expires < time.monotonic():
+                    del self._data[key]
+                elif limit <= cached_limit or complete:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    get_metrics().history_lookup(hit=True)
+                    return entries[:limit]
+            self.misses += 1
+        get_metrics().history_lookup(hit=False)
+        return None
+
+    def set(self, key: HistoryKey, entries: List[Any], limit: int) -> None:
+        """
+        :param entries: Up to `limit` newest entries, fewer entries mean that the history is complete.
+        """
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, limit, len(entries) < limit, list(entries))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def add(self, key: HistoryKey, log_entry: Any) -> None:
+        """
+        Add a new entry to the history if it is cached.
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                expires, limit, complete, entries = item
+                entries = [log_entry] + entries
+                if len(entries) > limit:
+                    entries = entries[:limit]
+                    complete = False
+                self._data[key] = (expires, limit, complete, entries)
+
+    def invalidate(self, key: HistoryKey) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+_cache = None
+
+
+def get_history_cache() -> Optional[HistoryCache]:
+    global _cache
+    if _cache is None and conf.HISTORY_CACHE_SIZE:
+        _cache = HistoryCache(conf.HISTORY_CACHE_SIZE, conf.HISTORY_CACHE_TTL)
+    return _cache
+
+
+def set_history_cache(cache: Optional[HistoryCache]) -> None:
+    global _cache
+    _cache = cache
+
+
+def update_history_cache(log_entries: List[Any]) -> None:
+    """
+    Add committed log entries to cached histories, does nothing unless `AUDITLOG_HISTORY_CACHE_SIZE` is set.
+
+    :param log_entries: The log entries the sink reported as saved, as written by
+        :py:meth:`auditlog.documents.LogEntry.log_create`, so cached entries are the same as the stored ones.
+    """
+    cache = get_history_cache()
+    if cache is None:
+        return
+    for log_entry in log_entries:
+        key = (log_entry.tenant, log_entry.table_name, log_entry.object_pk)
+        if key in cache:
+            cache.add(key, log_entry)
+
+
+def get_object_history(model: Any, pk: Any, limit: int = 20, tenant: Optional[str] = None) -> List[Any]:
+    """
+    Returns the newest log entries of an object, read through the history cache when it is enabled.
+
+    :param model: The model or its table name.
+    :param pk: The primary key value of the object.
+    :param limit: Maximal number of returned entries.
+    :param tenant: The tenant of the object, defaults to the tenant of the current context.
+    :return: Log entries sorted from the newest.
+    """
+    if tenant is None:
+        tenant = get_tenant()
+    table_name = model if isinstance(model, str) else model.__tablename__
+    key = (tenant, table_name, str(pk))
+    cache = get_history_cache()
+    if cache is not None:
+        entries = cache.get(key, limit)
+        if entries is not None:
+            return entries
+    search = routing.search(tenant) \
+        .filter('term', table_name=table_name) \
+        .filter('term', object_pk=str(pk)) \
+        .sort('-timestamp', {'sequence': {'order': 'desc', 'unmapped_type': 'integer'}})[:limit]
+    entries = list(search.execute())
+    if cache is not None:
+        cache.set(key, entries, limit)
+    return entries
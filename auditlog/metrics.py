@@ -0,0 +1,137 @@
+from typing import Any, Optional
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+
+class AuditlogMetrics:
+    """
+    Receives measurements of the audit pipeline. All hooks do nothing, subclass and override the ones you need,
+    then install the instance with :py:func:`set_metrics`.
+    """
+
+    def flush_processed(self, duration: float, entries: int) -> None:
+        """
+        Called after flushed instances were processed.
+
+        :param duration: Time spent on computing the changes, in seconds.
+        :param entries: Number of log entries created by the flush.
+        """
+
+    def entry_captured(self, table_name: str, action: str) -> None:
+        """
+        Called for every log entry created by a flush.
+        """
+
+    def entries_pending(self, count: int) -> None:
+        """
+        Called on commit with the number of log entries waiting to be saved.
+        """
+
+    def entries_shipped(self, duration: float, count: int) -> None:
+        """
+        Called after log entries of a commit were saved.
+
+        :param duration: Time spent on saving the entries, in seconds.
+        :param count: Number of saved entries.
+        """
+
+    def entry_saved(self, log_entry: Any, size: Optional[int] = None) -> None:
+        """
+        Called for every log entry successfully written by the sink.
+
+        :param size: Size of the serialized entry in bytes, `None` if the sink does not serialize entries.
+        """
+
+    def entry_failed(self, log_entry: Any) -> None:
+        """
+        Called for every log entry the sink could not write.
+        """
+
+    def history_lookup(self, hit: bool) -> None:
+        """
+        Called for every lookup in the history cache.
+        """
+
+
+class PrometheusMetrics(AuditlogMetrics):
+    """
+    Exposes the measurements as Prometheus metrics, requires `prometheus_client` package.
+    """
+
+    def __init__(self, namespace: str = 'auditlog', registry: Any = None):
+        if prometheus_client is None:
+            raise ImportError("Install `prometheus_client` to use PrometheusMetrics")
+        if registry is None:
+            registry = prometheus_client.REGISTRY
+        self.flush_duration = prometheus_client.Histogram(
+            'flush_duration_seconds', 'Time spent on computing changes of a flush',
+            namespace=namespace, registry=registry,
+        )
+        self.flush_entries = prometheus_client.Histogram(
+            'flush_entries', 'Number of log entries created by a flush',
+            namespace=namespace, registry=registry,
+            buckets=(0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000, float('inf')),
+        )
+        self.entries = prometheus_client.Counter(
+            'entries_total', 'Number of created log entries', ['table_name', 'action'],
+            namespace=namespace, registry=registry,
+        )
+        self.pending = prometheus_client.Gauge(
+            'entries_pending', 'Number of log entries waiting to be saved on the last commit',
+            namespace=namespace, registry=registry,
+        )
+        self.ship_duration = prometheus_client.Histogram(
+            'ship_duration_seconds', 'Time spent on saving log entries of a commit',
+            namespace=namespace, registry=registry,
+        )
+        self.serialized_bytes = prometheus_client.Histogram(
+            'entry_size_bytes', 'Size of serialized log entries',
+            namespace=namespace, registry=registry,
+            buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, float('inf')),
+        )
+        self.failures = prometheus_client.Counter(
+            'failures_total', 'Number of log entries that could not be saved', ['table_name'],
+            namespace=namespace, registry=registry,
+        )
+        self.history_lookups = prometheus_client.Counter(
+            'history_cache_lookups_total', 'Number of lookups in the history cache', ['result'],
+            namespace=namespace, registry=registry,
+        )
+
+    def flush_processed(self, duration: float, entries: int) -> None:
+        self.flush_duration.observe(duration)
+        self.flush_entries.observe(entries)
+
+    def entry_captured(self, table_name: str, action: str) -> None:
+        self.entries.labels(table_name=table_name, action=action).inc()
+
+    def entries_pending(self, count: int) -> None:
+        self.pending.set(count)
+
+    def entries_shipped(self, duration: float, count: int) -> None:
+        self.ship_duration.observe(duration)
+
+    def entry_saved(self, log_entry: Any, size: Optional[int] = None) -> None:
+        if size is not None:
+            self.serialized_bytes.observe(size)
+
+    def entry_failed(self, log_entry: Any) -> None:
+        self.failures.labels(table_name=log_entry.table_name or '').inc()
+
+    def history_lookup(self, hit: bool) -> None:
+        self.history_lookups.labels(result='hit' if hit else 'miss').inc()
+
+
+_metrics = AuditlogMetrics()
+
+
+def get_metrics() -> AuditlogMetrics:
+    return _metrics
+
+
+def set_metrics(metrics: AuditlogMetrics) -> None:
+    global _metrics
+    _metrics = metrics
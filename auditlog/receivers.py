@@ -1,39 +1,57 @@
+import logging
+import time
+import uuid
+from datetime import datetime
+
 from sqlalchemy.orm import Session
 
-from auditlog.diff import set_entry_attributes
+from auditlog import conf
+from auditlog.diff import set_entries_attributes
 from auditlog.documents import log_entry_class
+from auditlog.history import update_history_cache
+from auditlog.metrics import get_metrics
+from auditlog.registry import auditlog
+from auditlog.rollup import record_entries
+from auditlog.sinks import get_sink
 
 
 def track_instances_after_flush(session: Session, context):
+    start = time.perf_counter()
     entry_attrs = session.info.setdefault('entry_attrs', list())
+    count = len(entry_attrs)
     user = session.info.get('user')
-    for obj in session.new:
-        set_entry_attributes(
-            obj,
-            log_entry_class().Action.CREATE,
-            entry_attrs,
-            user
-        )
-    for obj in session.dirty:
-        set_entry_attributes(
-            obj,
-            log_entry_class().Action.UPDATE,
-            entry_attrs,
-            user
-        )
-    for obj in session.deleted:
-        set_entry_attributes(
-            obj,
-            log_entry_class().Action.DELETE,
-            entry_attrs,
-            user
+    entry_class = log_entry_class()
+    timestamp = datetime.now()
+    set_entries_attributes(session.new, entry_class.Action.CREATE, entry_attrs, user, timestamp)
+    set_entries_attributes(session.dirty, entry_class.Action.UPDATE, entry_attrs, user, timestamp)
+    set_entries_attributes(session.deleted, entry_class.Action.DELETE, entry_attrs, user, timestamp)
+    duration = time.perf_counter() - start
+    metrics = get_metrics()
+    for kwargs in entry_attrs[count:]:
+        metrics.entry_captured(kwargs['table_name'], kwargs['action'])
+    metrics.flush_processed(duration, len(entry_attrs) - count)
+    if conf.SLOW_FLUSH_THRESHOLD and duration > conf.SLOW_FLUSH_THRESHOLD:
+        logging.warning(
+            "Auditlog spent %.3fs on a flush of %d instances",
+            duration, len(session.new) + len(session.dirty) + len(session.deleted)
         )
 
 
 def save_log_entries_after_commit(session: Session):
-    entry_attrs = session.info.get('entry_attrs')
+    # Removed before saving, so entries are never saved again by the next commit if saving fails
+    entry_attrs = session.info.pop('entry_attrs', None)
     if entry_attrs:
-        for kwargs in entry_attrs:
-            log_entry_class().log_create(kwargs)
-        del session.info['entry_attrs']
-
+        metrics = get_metrics()
+        metrics.entries_pending(len(entry_attrs))
+        start = time.perf_counter()
+        transaction_id = uuid.uuid4().hex
+        with get_sink().batch() as saved_entries:
+            for sequence, kwargs in enumerate(entry_attrs):
+                kwargs.setdefault('transaction_id', transaction_id)
+                kwargs.setdefault('sequence', sequence)
+                log_entry_class().log_create(kwargs)
+        metrics.entries_shipped(time.perf_counter() - start, len(entry_attrs))
+        record_entries(entry_attrs)
+        # Entries the sink failed to write are not added, cached histories show only stored entries
+        update_history_cache(saved_entries)
+        auditlog.dispatch(entry_attrs)
@@ -1,8 +1,54 @@
-from typing import Optional, List, Tuple, Any
+import hashlib
+import logging
+from concurrent.futures import Executor, Future
+from typing import Optional, List, Tuple, Any, Callable, NamedTuple
 
 DispatchUID = Tuple[int, str, int]
 
 
+class ChangeEvent(NamedTuple):
+    """
+    Committed change of a model instance passed to subscribers.
+    """
+    table_name: str
+    action: str
+    object_pk: str
+    fields: List[str]
+    entry: dict
+
+
+class AuditPlan(NamedTuple):
+    """
+    Attributes tracked for a registered model.
+    """
+    columns: Tuple[str, ...]
+    relationships: Tuple[str, ...]
+    compact: bool = False
+    # Identifies the field order of compact encoded changes, set only for compact models
+    schema_version: Optional[str] = None
+
+    @property
+    def fields(self) -> Tuple[str, ...]:
+        return self.columns + self.relationships
+
+
+def make_schema_version(columns: Tuple[str, ...], relationships: Tuple[str, ...]) -> str:
+    key = ','.join(columns) + '|' + ','.join(relationships)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+
+
+class Subscription(NamedTuple):
+    model: Any
+    callback: Callable[[List[ChangeEvent]], Any]
+    fields: Optional[frozenset]
+    executor: Optional[Executor]
+
+
+def _log_subscriber_error(future: Future) -> None:
+    if future.exception() is not None:
+        logging.error("Error in auditlog subscriber", exc_info=future.exception())
+
+
 class AuditlogModelRegistry:
     """
     A registry that keeps track of the models that use Auditlog to track changes.
@@ -11,10 +57,14 @@ class AuditlogModelRegistry:
     def __init__(self):
 
         self._registry = {}
+        self._subscriptions = {}
+        self._plans = {}
+        self._schemas = {}
 
     def register(
         self, model: Any = None, include_fields: Optional[List[str]] = None,
-        exclude_fields: Optional[List[str]] = None,
+        exclude_fields: Optional[List[str]] = None, relationship_fields: Optional[List[str]] = None,
+        compact: bool = False,
     ) -> Any:
         """
         Register a model with auditlog. Auditlog will then track mutations on this model's instances.
@@ -22,6 +72,10 @@ class AuditlogModelRegistry:
         :param model: The model to register.
         :param include_fields: The fields to include. Implicitly excludes all other fields.
         :param exclude_fields: The fields to exclude. Overrides the fields to include.
+        :param relationship_fields: The relationships to track, primary keys of added and removed objects are
+            logged. Only changes already held in memory are logged, collections are never loaded.
+        :param compact: Store the changes packed in a binary field instead of a list of objects, for high-volume
+            tables. Only the names of the changed fields are indexed.
 
         """
 
@@ -29,13 +83,18 @@ class AuditlogModelRegistry:
             include_fields = []
         if exclude_fields is None:
             exclude_fields = []
+        if relationship_fields is None:
+            relationship_fields = []
 
         def registrar(cls):
             """Register models for a given class."""
             self._registry[cls] = {
                 'include_fields': include_fields,
                 'exclude_fields': exclude_fields,
+                'relationship_fields': relationship_fields,
+                'compact': compact,
             }
+            self._plans.pop(cls, None)
             # We need to return the class, as the decorator is basically
             # syntactic sugar for:
             # MyClass = auditlog.register(MyClass)
@@ -69,14 +128,143 @@ class AuditlogModelRegistry:
             del self._registry[model]
         except KeyError:
             pass
+        self._plans.pop(model, None)
+
+    def subscribe(
+        self, model: Any, callback: Callable[[List[ChangeEvent]], Any] = None, fields: Optional[List[str]] = None,
+        executor: Optional[Executor] = None,
+    ) -> Any:
+        """
+        Subscribe to committed changes of a model. The callback is called once per commit with the list of
+        :py:class:`ChangeEvent` of the model, changes of other models sharing its table are not passed.
+
+        :param model: The registered model.
+        :param callback: The callable receiving the list of events.
+        :param fields: Call the callback only for creations, deletions and updates of these fields.
+        :param executor: Run the callback in this executor, e.g. a thread pool, instead of the committing thread.
+        """
+
+        def subscriber(func):
+            subscription = Subscription(model, func, frozenset(fields) if fields else None, executor)
+            table_name = model.__tablename__
+            # Replace the list, so dispatching never sees a list being modified
+            self._subscriptions[table_name] = self._subscriptions.get(table_name, []) + [subscription]
+            return func
+
+        if callback is None:
+            # If we're being used as a decorator, return a callable with the
+            # wrapper.
+            return subscriber
+        else:
+            subscriber(callback)
+
+    def unsubscribe(self, model: Any, callback: Callable[[List[ChangeEvent]], Any]) -> None:
+        """
+        Remove all subscriptions of the callback to the model.
+        """
+        table_name = model.__tablename__
+        subscriptions = [
+            subscription for subscription in self._subscriptions.get(table_name, [])
+            if not (subscription.model is model and subscription.callback == callback)
+        ]
+        if subscriptions:
+            self._subscriptions[table_name] = subscriptions
+        else:
+            self._subscriptions.pop(table_name, None)
+
+    def dispatch(self, entries: List[dict]) -> None:
+        """
+        Pass committed log entries to the subscribers.
+
+        :param entries: Field values of the log entries.
+        """
+        from auditlog.documents import log_entry_class
+
+        if not self._subscriptions:
+            return
+        update = log_entry_class().Action.UPDATE
+        events = {}
+        for kwargs in entries:
+            if kwargs['table_name'] in self._subscriptions:
+                events.setdefault(kwargs['table_name'], []).append(ChangeEvent(
+                    kwargs['table_name'],
+                    kwargs['action'],
+                    kwargs['object_pk'],
+                    [change['field'] for change in kwargs.get('changes') or ()],
+                    kwargs,
+                ))
+        for table_name, table_events in events.items():
+            for subscription in self._subscriptions.get(table_name, ()):
+                # Entries built without `LogEntry.get_fields` don't know their model, they match by table
+                subscription_events = [
+                    event for event in table_events
+                    if event.entry.get('_model', subscription.model) is subscription.model
+                    and (subscription.fields is None or event.action != update
+                         or not subscription.fields.isdisjoint(event.fields))
+                ]
+                if not subscription_events:
+                    continue
+                if subscription.executor is not None:
+                    future = subscription.executor.submit(subscription.callback, subscription_events)
+                    future.add_done_callback(_log_subscriber_error)
+                else:
+                    try:
+                        subscription.callback(subscription_events)
+                    except Exception:
+                        logging.exception("Error in auditlog subscriber %r", subscription.callback)
 
     def get_models(self) -> List:
         return list(self._registry.keys())
 
+    def get_audit_plan(self, model: Any) -> AuditPlan:
+        """
+        Returns the tracked attributes of a registered model, computed once per registration.
+
+        :param model: The registered model.
+        """
+        plan = self._plans.get(model)
+        if plan is None:
+            from auditlog.diff import get_audited_column_keys
+
+            columns = tuple(get_audited_column_keys(model))
+            relationships = tuple(self._registry[model]['relationship_fields'])
+            compact = self._registry[model].get('compact', False)
+            plan = self._plans[model] = AuditPlan(
+                columns=columns,
+                relationships=relationships,
+                compact=compact,
+                schema_version=make_schema_version(columns, relationships) if compact else None,
+            )
+            if plan.compact:
+                self._schemas[plan.schema_version] = plan.fields
+        return plan
+
+    def get_schema(self, version: str) -> Tuple[str, ...]:
+        """
+        Returns the field order of a compact encoding schema. Versions not used by the current registrations
+        are read from the schema store, see :py:func:`auditlog.compact.get_schema_store`.
+
+        :param version: The schema version stored with the log entry.
+        :raises KeyError: If the schema is not known.
+        """
+        if version not in self._schemas:
+            for model in list(self._registry):
+                if self._registry[model].get('compact'):
+                    self.get_audit_plan(model)
+        if version not in self._schemas:
+            from auditlog.compact import get_schema_store
+
+            fields = get_schema_store().get(version)
+            if fields is None:
+                raise KeyError(version)
+            self._schemas[version] = fields
+        return self._schemas[version]
+
     def get_model_fields(self, model: Any):
         return {
             'include_fields': list(self._registry[model]['include_fields']),
             'exclude_fields': list(self._registry[model]['exclude_fields']),
+            'relationship_fields': list(self._registry[model]['relationship_fields']),
         }
 
 
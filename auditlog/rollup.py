@@ -0,0 +1,254 @@
+"""
+Hourly counts of log entries per table, action and actor, kept in a separate index, so activity
+dashboards don't have to aggregate the raw log entries.
+
+Counts of entries written since the rollup was enabled are collected in-process, existing entries are
+counted with::
+
+    python -m auditlog.rollup backfill --since 2021-01-01
+"""
+import argparse
+import atexit
+import hashlib
+import logging
+import threading
+from collections import Counter
+from datetime import datetime
+from typing import Iterable, List, Optional, Tuple
+
+from elasticsearch.helpers import bulk
+from elasticsearch_dsl import Document, Keyword, Date, Long, A, connections
+
+from auditlog import conf
+
+RollupKey = Tuple[str, str, Optional[str], datetime]
+
+
+class ActivityRollup(Document):
+    table_name = Keyword()
+    action = Keyword()
+    actor_id = Keyword()
+    # Start of the hour
+    timestamp = Date()
+    count = Long()
+
+    class Index:
+        name = conf.ROLLUP_INDEX_NAME
+
+    @staticmethod
+    def make_id(key: RollupKey) -> str:
+        table_name, action, actor_id, bucket = key
+        return hashlib.sha1(f'{table_name}:{action}:{actor_id}:{bucket.isoformat()}'.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def make_source(key: RollupKey, count: int) -> dict:
+        table_name, action, actor_id, bucket = key
+        return {
+            'table_name': table_name,
+            'action': action,
+            'actor_id': actor_id,
+            'timestamp': bucket.isoformat(),
+            'count': count,
+        }
+
+
+def get_bucket(timestamp: datetime) -> datetime:
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+class ActivityRollupCounter:
+    """
+    Counts log entries in memory and adds the counts to the rollup index once per `interval` seconds,
+    from a background thread started with :py:meth:`start`, so committing never waits for Elasticsearch.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._counts = Counter()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._initialized = False
+
+    @property
+    def counts(self) -> Counter:
+        with self._lock:
+            return Counter(self._counts)
+
+    def record(self, entries: Iterable[dict]) -> None:
+        """
+        :param entries: Field values of log entries.
+        """
+        with self._lock:
+            for kwargs in entries:
+                actor_id = kwargs.get('actor_id')
+                self._counts[(
+                    kwargs['table_name'],
+                    kwargs['action'],
+                    str(actor_id) if actor_id is not None else None,
+                    get_bucket(kwargs['timestamp']),
+                )] += 1
+
+    def start(self) -> None:
+        """
+        Start flushing the counts periodically in a daemon thread.
+        """
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name='auditlog-rollup', daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop the background thread and flush the remaining counts.
+        """
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            counts, self._counts = self._counts, Counter()
+        if not counts:
+            return
+        try:
+            self._save(counts)
+        except Exception:
+            logging.exception("Error when saving activity rollup to elasticsearch")
+            # Keep the counts for the next attempt
+            with self._lock:
+                self._counts.update(counts)
+
+    def _save(self, counts: Counter) -> None:
+        if not self._initialized:
+            # Created before the first upsert, dynamic mapping would not map the fields as keywords
+            ActivityRollup.init()
+            self._initialized = True
+        actions = (
+            {
+                '_op_type': 'update',
+                '_index': ActivityRollup._index._name,
+                '_id': ActivityRollup.make_id(key),
+                'script': {
+                    'source': 'ctx._source.count += params.count',
+                    'lang': 'painless',
+                    'params': {'count': count},
+                },
+                'upsert': ActivityRollup.make_source(key, count),
+                'retry_on_conflict': 3,
+            }
+            for key, count in counts.items()
+        )
+        bulk(connections.get_connection(), actions)
+
+
+_counter = None
+_disabled = False
+
+
+def get_counter() -> Optional[ActivityRollupCounter]:
+    global _counter, _disabled
+    if _counter is None and conf.ROLLUP_INTERVAL and not _disabled:
+        if conf.SINK != 'elasticsearch':
+            # The rollup index lives in Elasticsearch, which is not used by other sinks
+            logging.warning("AUDITLOG_ROLLUP_INTERVAL is ignored, the activity rollup requires the elasticsearch sink")
+            _disabled = True
+            return None
+        _counter = ActivityRollupCounter(conf.ROLLUP_INTERVAL)
+        _counter.start()
+        atexit.register(_counter.stop)
+    return _counter
+
+
+def record_entries(entries: List[dict]) -> None:
+    """
+    Add log entries to the rollup, does nothing unless `AUDITLOG_ROLLUP_INTERVAL` is set.
+    """
+    counter = get_counter()
+    if counter is not None:
+        counter.record(entries)
+
+
+def backfill(since: Optional[datetime] = None, until: Optional[datetime] = None, size: int = 1000) -> int:
+    """
+    Count existing log entries and write the counts to the rollup index, replacing counts of the same hours.
+
+    :param since: Count entries from this time, inclusive.
+    :param until: Count entries up to this time, exclusive.
+    :param size: Number of buckets requested at once.
+    :return: Number of written rollup documents.
+    """
+    from auditlog.routing import search as search_entries
+
+    ActivityRollup.init()
+    # All tenants are counted
+    search = search_entries()
+    if since or until:
+        time_range = {}
+        if since:
+            time_range['gte'] = since
+        if until:
+            time_range['lt'] = until
+        search = search.filter('range', timestamp=time_range)
+
+    written = 0
+    after = None
+    while True:
+        params = {
+            'size': size,
+            'sources': [
+                {'timestamp': {'date_histogram': {'field': 'timestamp', 'fixed_interval': '1h'}}},
+                {'table_name': {'terms': {'field': 'table_name'}}},
+                {'action': {'terms': {'field': 'action'}}},
+                {'actor_id': {'terms': {'field': 'actor_id', 'missing_bucket': True}}},
+            ],
+        }
+        if after:
+            params['after'] = after
+        page = search.extra(size=0)
+        page.aggs.bucket('activity', A('composite', **params))
+        aggregation = page.execute().aggregations.activity
+        actions = []
+        for bucket in aggregation.buckets:
+            key = (
+                bucket.key.table_name,
+                bucket.key.action,
+                bucket.key.actor_id,
+                datetime.utcfromtimestamp(bucket.key.timestamp / 1000),
+            )
+            actions.append({
+                '_op_type': 'index',
+                '_index': ActivityRollup._index._name,
+                '_id': ActivityRollup.make_id(key),
+                '_source': ActivityRollup.make_source(key, bucket.doc_count),
+            })
+        if actions:
+            bulk(connections.get_connection(), actions)
+            written += len(actions)
+        after = getattr(aggregation, 'after_key', None)
+        if not actions or after is None:
+            return written
+        after = after.to_dict()
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description="Activity rollup of the audit log")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    backfill_parser = subparsers.add_parser('backfill', help='count existing log entries')
+    backfill_parser.add_argument('--since', type=datetime.fromisoformat, help='ISO date or datetime, inclusive')
+    backfill_parser.add_argument('--until', type=datetime.fromisoformat, help='ISO date or datetime, exclusive')
+    args = parser.parse_args(argv)
+
+    if args.command == 'backfill':
+        written = backfill(args.since, args.until)
+        print(f"Written {written} rollup documents to {ActivityRollup._index._name}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+import hashlib
+import logging
+import re
+from typing import Any, Callable, NamedTuple, Optional
+
+from elasticsearch_dsl import IndexTemplate, Search
+
+from auditlog import conf
+from auditlog.context import get_tenant
+
+
+class Route(NamedTuple):
+    """
+    Destination of a log entry.
+    """
+    index: str
+    routing: Optional[str] = None
+
+
+# Characters allowed in index names, besides those only invalid at the start
+_INVALID_INDEX_CHARS = re.compile(r'[^a-z0-9_.-]')
+MAX_TENANT_INDEX_LENGTH = 100
+
+
+def get_tenant_index(tenant: str) -> str:
+    """
+    Returns the index of a tenant. Tenants that are not valid in index names, e.g. with uppercase letters or
+    spaces, are lowercased, invalid characters are replaced and a hash of the tenant is appended,
+    so different tenants never share an index.
+    """
+    name = _INVALID_INDEX_CHARS.sub('_', tenant.lower())
+    if name != tenant or len(name) > MAX_TENANT_INDEX_LENGTH:
+        digest = hashlib.sha1(tenant.encode('utf-8')).hexdigest()[:8]
+        name = f'{name[:MAX_TENANT_INDEX_LENGTH]}-{digest}'
+    return f'{conf.INDEX_NAME}-tenant-{name}'
+
+
+def get_index_template() -> IndexTemplate:
+    """
+    Returns the template applying the mapping of log entries to the indices of tenants.
+    """
+    from auditlog.documents import log_entry_class
+
+    return log_entry_class()._index.as_template(f'{conf.INDEX_NAME}-tenant', pattern=f'{conf.INDEX_NAME}-tenant-*')
+
+
+_template_installed = False
+
+
+def install_index_template() -> None:
+    """
+    Install the index template of tenant indices once per process, before the first log entry is written to them.
+    Nothing is done unless `AUDITLOG_TENANT_ROUTING` is `index`.
+    """
+    global _template_installed
+    if _template_installed or conf.TENANT_ROUTING != 'index':
+        return
+    try:
+        get_index_template().save()
+    except Exception:
+        logging.exception("Error when saving index template of tenants to elasticsearch")
+    else:
+        _template_installed = True
+
+
+def default_tenant_resolver(instance: Any) -> Optional[str]:
+    return get_tenant()
+
+
+def default_router(tenant: Optional[str]) -> Route:
+    if tenant is None or conf.TENANT_ROUTING == 'none':
+        return Route(conf.INDEX_NAME)
+    if conf.TENANT_ROUTING == 'index':
+        return Route(get_tenant_index(tenant))
+    if conf.TENANT_ROUTING == 'routing':
+        return Route(conf.INDEX_NAME, tenant)
+    raise ValueError(f"Unknown tenant routing `{conf.TENANT_ROUTING}`")
+
+
+_tenant_resolver = default_tenant_resolver
+_router = default_router
+
+
+def set_tenant_resolver(resolver: Callable[[Any], Optional[str]]) -> None:
+    """
+    Set the function returning the tenant of a changed instance. The instance is `None` for bulk
+    mappings. By default the tenant is read from :py:func:`auditlog.context.set_tenant`.
+    """
+    global _tenant_resolver
+    _tenant_resolver = resolver
+
+
+def set_router(router: Callable[[Optional[str]], Route]) -> None:
+    """
+    Set the function returning the :py:class:`Route` of log entries of a tenant.
+    The router must return valid index names.
+    """
+    global _router
+    _router = router
+
+
+def resolve_tenant(instance: Any) -> Optional[str]:
+    return _tenant_resolver(instance)
+
+
+def get_route(tenant: Optional[str]) -> Route:
+    return _router(tenant)
+
+
+def get_search_index(tenant: Optional[str]) -> str:
+    """
+    Returns the indices containing log entries of the tenant, or of all tenants if it is `None`.
+    """
+    if tenant is None and conf.TENANT_ROUTING == 'index':
+        return f'{conf.INDEX_NAME},{conf.INDEX_NAME}-tenant-*'
+    return get_route(tenant).index
+
+
+def search(tenant: Optional[str] = None) -> Search:
+    """
+    Search log entries of the tenant, only its index and shards are searched.
+
+    :param tenant: The tenant, defaults to the tenant of the current context.
+        Log entries of all tenants are searched if there is no tenant.
+    """
+    from auditlog.documents import log_entry_class
+
+    if tenant is None:
+        tenant = get_tenant()
+    result = log_entry_class().search(index=get_search_index(tenant))
+    if tenant is not None:
+        routing = get_route(tenant).routing
+        if routing:
+            result = result.params(routing=routing)
+        result = result.filter('term', tenant=tenant)
+    return result
@@ -0,0 +1,151 @@
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import Sequence, func, inspect, select
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session, class_mapper
+
+from auditlog.diff import model_instance_diff, set_mapping_entry_attributes
+from auditlog.documents import log_entry_class
+
+CHUNK_SIZE = 1000
+
+# Sequences generating primary keys by table and column, `None` if the keys can't be allocated in advance
+_sequences: Dict[Tuple[str, str], Optional[str]] = {}
+
+
+def _chunks(items: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(items)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _get_pk_keys(model: Any) -> List[str]:
+    mapper = class_mapper(model)
+    return [mapper.get_property_by_column(column).key for column in mapper.primary_key]
+
+
+def _get_pk_sequence(connection: Connection, model: Any) -> Optional[str]:
+    """
+    Get the name of the sequence generating the one column primary key of the model on PostgreSQL.
+    """
+    mapper = class_mapper(model)
+    if connection.dialect.name != 'postgresql' or len(mapper.primary_key) != 1:
+        return None
+    column = mapper.primary_key[0]
+    key = (column.table.fullname, column.name)
+    if key not in _sequences:
+        if isinstance(column.default, Sequence):
+            sequence = column.default
+            _sequences[key] = f'{sequence.schema}.{sequence.name}' if sequence.schema else sequence.name
+        else:
+            _sequences[key] = connection.scalar(
+                select([func.pg_get_serial_sequence(column.table.fullname, column.name)])
+            )
+    return _sequences[key]
+
+
+class AuditlogSessionMixin:
+    """
+    Session mixin logging bulk operations, which are not seen by
+    :py:func:`auditlog.receivers.track_instances_after_flush`.
+
+    Items are processed in chunks of :py:data:`CHUNK_SIZE`, so mappings can be passed as a generator.
+    On PostgreSQL missing primary keys of inserted items are allocated from their sequence with one query
+    per chunk, so the log entries get the primary keys without inserting the rows one by one.
+    Elsewhere the entries are logged without the primary key unless `return_defaults=True` is passed.
+    """
+
+    def _get_model(self, mapper: Any) -> Any:
+        return getattr(mapper, 'class_', mapper)
+
+    def _allocate_pks(self, model: Any, count: int) -> Optional[List[Any]]:
+        """
+        Get `count` new values of the primary key of the model, `None` if they can't be allocated in advance.
+        """
+        connection = self.connection(mapper=class_mapper(model))
+        sequence = _get_pk_sequence(connection, model)
+        if sequence is None:
+            return None
+        query = select([func.nextval(sequence)]).select_from(func.generate_series(1, count))
+        return [row[0] for row in connection.execute(query)]
+
+    def bulk_insert_mappings(self, mapper, mappings, return_defaults=False, render_nulls=False):
+        from auditlog.registry import auditlog
+
+        model = self._get_model(mapper)
+        if not auditlog.contains(model):
+            return super().bulk_insert_mappings(mapper, mappings, return_defaults, render_nulls)
+        entry_attrs = self.info.setdefault('entry_attrs', list())
+        pk_keys = _get_pk_keys(model)
+        for chunk in _chunks(mappings, CHUNK_SIZE):
+            if not return_defaults:
+                missing = [mapping for mapping in chunk if any(mapping.get(key) is None for key in pk_keys)]
+                pks = self._allocate_pks(model, len(missing)) if missing else None
+                for mapping, pk in zip(missing, pks or []):
+                    mapping[pk_keys[0]] = pk
+            super().bulk_insert_mappings(mapper, chunk, return_defaults, render_nulls)
+            set_mapping_entry_attributes(
+                model, log_entry_class().Action.CREATE, chunk, entry_attrs, self.info.get('user')
+            )
+
+    def bulk_update_mappings(self, mapper, mappings):
+        from auditlog.registry import auditlog
+
+        model = self._get_model(mapper)
+        if not auditlog.contains(model):
+            return super().bulk_update_mappings(mapper, mappings)
+        entry_attrs = self.info.setdefault('entry_attrs', list())
+        for chunk in _chunks(mappings, CHUNK_SIZE):
+            super().bulk_update_mappings(mapper, chunk)
+            set_mapping_entry_attributes(
+                model, log_entry_class().Action.UPDATE, chunk, entry_attrs, self.info.get('user')
+            )
+
+    def bulk_save_objects(self, objects, return_defaults=False, update_changed_only=True, preserve_order=True):
+        from auditlog.registry import auditlog
+
+        entry_class = log_entry_class()
+        entry_attrs = self.info.setdefault('entry_attrs', list())
+        user_ref = self.info.get('user')
+        for chunk in _chunks(objects, CHUNK_SIZE):
+            # Changes are read before saving, bulk save doesn't keep the attribute history consistent.
+            # Objects of this session stay modified and are logged by its next flush.
+            pending = [
+                (
+                    obj,
+                    entry_class.Action.UPDATE if inspect(obj).key else entry_class.Action.CREATE,
+                    model_instance_diff(obj),
+                )
+                for obj in chunk if obj not in self and auditlog.contains(obj.__class__)
+            ]
+            if not return_defaults:
+                self._allocate_object_pks(
+                    obj for obj, action, changes in pending if changes and action == entry_class.Action.CREATE
+                )
+            super().bulk_save_objects(chunk, return_defaults, update_changed_only, preserve_order)
+            for obj, action, changes in pending:
+                if changes:
+                    kwargs = entry_class.get_fields(obj, action=action, changes=changes)
+                    if user_ref and user_ref():
+                        entry_class.set_user_fields(user_ref(), kwargs)
+                    entry_attrs.append(kwargs)
+
+
+    def _allocate_object_pks(self, objects: Iterable[Any]) -> None:
+        missing = {}
+        for obj in objects:
+            pk_keys = _get_pk_keys(obj.__class__)
+            if any(inspect(obj).dict.get(key) is None for key in pk_keys):
+                missing.setdefault(obj.__class__, []).append((obj, pk_keys[0]))
+        for model, items in missing.items():
+            pks = self._allocate_pks(model, len(items))
+            for (obj, key), pk in zip(items, pks or []):
+                setattr(obj, key, pk)
+
+
+class AuditlogSession(AuditlogSessionMixin, Session):
+    pass
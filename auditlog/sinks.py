@@ -0,0 +1,239 @@
+import abc
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, List, Optional, Tuple
+
+from elasticsearch.helpers import streaming_bulk
+from elasticsearch.serializer import JSONSerializer
+from elasticsearch_dsl import connections
+
+from auditlog import conf
+from auditlog.metrics import get_metrics
+from auditlog.routing import install_index_template
+
+
+class Sink(abc.ABC):
+    """
+    Destination of log entries.
+
+    Entries are written immediately, unless they are written inside :py:meth:`batch`.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    @contextmanager
+    def batch(self):
+        """
+        Collect entries written by the current thread and write them together on exit.
+        Yields a list, filled on exit with the entries that were saved.
+        """
+        saved = []
+        if getattr(self._local, 'buffer', None) is not None:
+            # Nested batch, entries are written and reported by the outer one
+            yield saved
+            return
+        self._local.buffer = []
+        try:
+            yield saved
+        finally:
+            log_entries, self._local.buffer = self._local.buffer, None
+            if log_entries:
+                saved.extend(self.write_many(log_entries))
+
+    def write(self, log_entry: Any) -> None:
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None:
+            self.write_many([log_entry])
+        else:
+            buffer.append(log_entry)
+
+    @abc.abstractmethod
+    def write_many(self, log_entries: List[Any]) -> List[Any]:
+        """
+        Write the entries, errors are logged and reported to the metrics instead of being raised.
+
+        :return: The entries that were saved.
+        """
+
+
+class ElasticsearchSink(Sink):
+    """
+    Saves log entries to Elasticsearch with bulk requests, single entries too, so every entry is serialized once.
+    """
+
+    def __init__(self, chunk_size: int = 500):
+        super().__init__()
+        self.chunk_size = chunk_size
+        self._serializer = JSONSerializer()
+
+    def _get_action(self, log_entry: Any) -> dict:
+        log_entry.full_clean()
+        action = {
+            '_op_type': 'create',
+            # Serialized here to know its size, the bulk helper sends serialized sources as they are
+            '_source': self._serializer.dumps(log_entry.to_dict()),
+        }
+        document_id = getattr(log_entry.meta, 'id', None)
+        if document_id:
+            action['_id'] = document_id
+        return action
+
+    def write_many(self, log_entries: List[Any]) -> List[Any]:
+        install_index_template()
+        # Every destination gets its own bulk requests, with the index and routing set once per request
+        routes = {}
+        for log_entry in log_entries:
+            routes.setdefault(log_entry.get_route(), []).append(log_entry)
+        saved = []
+        for route, route_entries in routes.items():
+            saved.extend(self._write_route(route, route_entries))
+        return saved
+
+    def _write_route(self, route: Any, log_entries: List[Any]) -> List[Any]:
+        params = {'index': route.index}
+        if route.routing:
+            params['routing'] = route.routing
+        metrics = get_metrics()
+        # Build the actions first, an invalid entry fails alone instead of the whole batch
+        entries, actions = [], []
+        for log_entry in log_entries:
+            try:
+                actions.append(self._get_action(log_entry))
+            except Exception:
+                self._entry_failed(log_entry)
+            else:
+                entries.append(log_entry)
+        saved = []
+        if not actions:
+            return saved
+        results = streaming_bulk(
+            connections.get_connection(),
+            actions,
+            chunk_size=self.chunk_size,
+            raise_on_error=False,
+            raise_on_exception=False,
+            **params
+        )
+        done = 0
+        try:
+            for log_entry, action, (ok, item) in zip(entries, actions, results):
+                done += 1
+                result = item['create']
+                # 409 means the entry was saved by a previous attempt
+                if ok or result.get('status') == 409:
+                    metrics.entry_saved(log_entry, len(action['_source'].encode('utf-8')))
+                    saved.append(log_entry)
+                else:
+                    metrics.entry_failed(log_entry)
+                    logging.error(
+                        "Error when saving log to elasticsearch: %s", result.get('error'),
+                        extra={'log_entry': log_entry.to_dict()}
+                    )
+        except Exception:
+            # Errors other than transport errors, e.g. serialization, stop the whole stream
+            for log_entry in entries[done:]:
+                self._entry_failed(log_entry)
+        return saved
+
+    @staticmethod
+    def _entry_failed(log_entry: Any) -> None:
+        get_metrics().entry_failed(log_entry)
+        logging.exception(
+            "Error when saving log to elasticsearch",
+            extra={'log_entry': log_entry.to_dict()}
+        )
+
+
+class MemorySink(Sink):
+    """
+    Keeps the most recent log entries in memory, meant for tests.
+    """
+
+    def __init__(self, size: int = 10000):
+        super().__init__()
+        self._entries = deque(maxlen=size)
+
+    @property
+    def entries(self) -> List[Any]:
+        return list(self._entries)
+
+    def write_many(self, log_entries: List[Any]) -> List[Any]:
+        self._entries.extend(log_entries)
+        metrics = get_metrics()
+        for log_entry in log_entries:
+            metrics.entry_saved(log_entry)
+        return log_entries
+
+    def filter(self, **fields) -> List[Any]:
+        """
+        :param fields: Field values the entries must have, e.g. ``filter(table_name='user', action='create')``.
+        :return: Matching entries, oldest first.
+        """
+        return [
+            log_entry for log_entry in self._entries
+            if all(getattr(log_entry, name, None) == value for name, value in fields.items())
+        ]
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+class NDJSONFileSink(Sink):
+    """
+    Appends log entries to a file in the format of Elasticsearch bulk API,
+    so the file can be loaded later with ``curl -XPOST host:9200/_bulk --data-binary @file``.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self._serializer = JSONSerializer()
+        self._lock = threading.Lock()
+
+    def _get_lines(self, log_entry: Any) -> Tuple[str, str]:
+        log_entry.full_clean()
+        route = log_entry.get_route()
+        meta = {'_index': route.index}
+        if route.routing:
+            meta['routing'] = route.routing
+        document_id = getattr(log_entry.meta, 'id', None)
+        if document_id:
+            meta['_id'] = document_id
+        return self._serializer.dumps({'create': meta}), self._serializer.dumps(log_entry.to_dict())
+
+    def write_many(self, log_entries: List[Any]) -> List[Any]:
+        lines = [self._get_lines(log_entry) for log_entry in log_entries]
+        data = ''.join(f'{action}\n{source}\n' for action, source in lines)
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(data)
+        metrics = get_metrics()
+        for log_entry, (action, source) in zip(log_entries, lines):
+            metrics.entry_saved(log_entry, len(source.encode('utf-8')))
+        return log_entries
+
+
+_sink = None
+
+
+def get_sink() -> Sink:
+    global _sink
+    if _sink is None:
+        if conf.SINK == 'elasticsearch':
+            _sink = ElasticsearchSink()
+        elif conf.SINK == 'memory':
+            _sink = MemorySink(conf.SINK_MEMORY_SIZE)
+        elif conf.SINK == 'file':
+            if not conf.SINK_PATH:
+                raise ValueError("Set AUDITLOG_SINK_PATH as environment variable.")
+            _sink = NDJSONFileSink(conf.SINK_PATH)
+        else:
+            raise ValueError(f"Unknown sink `{conf.SINK}`")
+    return _sink
+
+
+def set_sink(sink: Optional[Sink]) -> None:
+    global _sink
+    _sink = sink
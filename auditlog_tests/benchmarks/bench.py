@@ -0,0 +1,175 @@
+"""
+Benchmarks of the auditlog write path.
+
+Compares the flush time of audited sessions with an un-audited baseline and measures the throughput of
+saving log entries. Runs on an in-memory SQLite database and a fake Elasticsearch server, so no services
+are needed. Results are emitted as JSON to compare them across commits::
+
+    python -m auditlog_tests.benchmarks.bench --counts 1 100 10000 --widths 5 50 --output results.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+from typing import Any, List
+
+import sqlalchemy
+from sqlalchemy import create_engine, event, Column, Integer, String
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+from auditlog_tests.benchmarks.fake_es import FakeElasticsearch
+
+BASELINE = 'baseline'
+CONFIGS = (BASELINE, 'all', 'include', 'exclude')
+
+
+def make_model(width: int) -> Any:
+    """
+    Create a model with `width` string columns on a fresh declarative base.
+    """
+    attrs = {
+        '__tablename__': f'bench_model_{width}',
+        'id': Column(Integer, primary_key=True),
+        '__str__': lambda self: f'Bench model {self.id}',
+    }
+    for i in range(width):
+        attrs[f'col_{i}'] = Column(String)
+    return type(f'BenchModel{width}', (declarative_base(),), attrs)
+
+
+def register(model: Any, config: str, width: int) -> None:
+    from auditlog.registry import auditlog
+
+    half = [f'col_{i}' for i in range(width // 2)]
+    if config == 'all':
+        auditlog.register(model)
+    elif config == 'include':
+        auditlog.register(model, include_fields=half)
+    elif config == 'exclude':
+        auditlog.register(model, exclude_fields=half)
+
+
+def run_once(model: Any, config: str, width: int, count: int, fake_es: FakeElasticsearch) -> dict:
+    from auditlog.receivers import save_log_entries_after_commit, track_instances_after_flush
+    from auditlog.registry import auditlog
+
+    engine = create_engine('sqlite://')
+    model.metadata.create_all(engine)
+    session_class = sessionmaker(bind=engine)
+    if config != BASELINE:
+        event.listen(session_class, 'after_flush', track_instances_after_flush)
+        event.listen(session_class, 'after_commit', save_log_entries_after_commit)
+        register(model, config, width)
+    session = session_class()
+    try:
+        objects = [model(**{f'col_{i}': f'value {n} {i}' for i in range(width)}) for n in range(count)]
+        session.add_all(objects)
+        start = time.perf_counter()
+        session.flush()
+        create_flush = time.perf_counter() - start
+
+        for obj in objects:
+            for i in range(width):
+                setattr(obj, f'col_{i}', f'changed {obj.id} {i}')
+        start = time.perf_counter()
+        session.flush()
+        update_flush = time.perf_counter() - start
+
+        fake_es.reset()
+        start = time.perf_counter()
+        session.commit()
+        commit = time.perf_counter() - start
+        return {
+            'create_flush_s': create_flush,
+            'update_flush_s': update_flush,
+            'commit_s': commit,
+            'entries': fake_es.documents,
+            'shipped_bytes': fake_es.bytes,
+        }
+    finally:
+        session.close()
+        auditlog.unregister(model)
+        engine.dispose()
+
+
+def run(counts: List[int], widths: List[int], configs: List[str], repeat: int, fake_es: FakeElasticsearch) -> list:
+    results = []
+    for width in widths:
+        model = make_model(width)
+        for count in counts:
+            baseline = None
+            for config in configs:
+                runs = [run_once(model, config, width, count, fake_es) for _ in range(repeat)]
+                result = {'config': config, 'width': width, 'count': count}
+                for key in ('create_flush_s', 'update_flush_s', 'commit_s'):
+                    result[key] = statistics.median(r[key] for r in runs)
+                result['entries'] = runs[0]['entries']
+                result['shipped_bytes'] = runs[0]['shipped_bytes']
+                result['create_us_per_object'] = result['create_flush_s'] / count * 1e6
+                result['update_us_per_object'] = result['update_flush_s'] / count * 1e6
+                result['entries_per_s'] = result['entries'] / result['commit_s'] if result['entries'] else None
+                if config == BASELINE:
+                    baseline = result
+                elif baseline is not None:
+                    result['create_overhead'] = result['create_flush_s'] / baseline['create_flush_s']
+                    result['update_overhead'] = result['update_flush_s'] / baseline['update_flush_s']
+                results.append(result)
+                print(
+                    f"{config:>8} width={width:<4} count={count:<7} "
+                    f"create={result['create_us_per_object']:.1f}us/obj "
+                    f"update={result['update_us_per_object']:.1f}us/obj "
+                    f"commit={result['commit_s']:.3f}s",
+                    file=sys.stderr
+                )
+    return results
+
+
+def get_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--counts', type=int, nargs='+', default=[1, 100, 1000, 10000],
+                        help='numbers of objects per flush')
+    parser.add_argument('--widths', type=int, nargs='+', default=[5, 50], help='numbers of columns of the model')
+    parser.add_argument('--configs', nargs='+', choices=CONFIGS, default=list(CONFIGS),
+                        help='registry configurations to compare')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per case, the median is reported')
+    parser.add_argument('--output', help='file to write results to, defaults to stdout')
+    args = parser.parse_args(argv)
+
+    with FakeElasticsearch() as fake_es:
+        # auditlog reads its configuration on import
+        os.environ['AUDITLOG_ELASTICSEARCH_HOST'] = fake_es.url
+        os.environ.setdefault('AUDITLOG_ELASTICSEARCH_PORT', str(fake_es.server.server_address[1]))
+        os.environ.setdefault('AUDITLOG_INDEX_NAME', 'auditlog-benchmark')
+        results = run(args.counts, args.widths, args.configs, args.repeat, fake_es)
+
+    report = {
+        'revision': get_revision(),
+        'timestamp': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'sqlalchemy': sqlalchemy.__version__,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
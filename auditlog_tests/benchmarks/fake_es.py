@@ -0,0 +1,104 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+
+class FakeElasticsearchHandler(BaseHTTPRequestHandler):
+    """
+    Answers the few Elasticsearch endpoints used by auditlog, documents are counted and dropped.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: dict) -> None:
+        data = json.dumps(body).encode('utf-8')
+        head = (
+            f'{self.protocol_version} {status} {self.responses[status][0]}\r\n'
+            f'Content-Type: application/json\r\n'
+            f'Content-Length: {len(data)}\r\n'
+            f'X-Elastic-Product: Elasticsearch\r\n\r\n'
+        ).encode('latin-1')
+        # Headers and body are sent in a single write, otherwise delayed acknowledgements dominate the latency
+        self.wfile.write(head if self.command == 'HEAD' else head + data)
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def do_HEAD(self):
+        self._send(200, {})
+
+    def do_GET(self):
+        self._send(200, {
+            'name': 'fake',
+            'cluster_name': 'fake',
+            'version': {'number': '7.17.0', 'build_flavor': 'default'},
+            'tagline': 'You Know, for Search',
+        })
+
+    def do_PUT(self):
+        path = urlparse(self.path).path.strip('/').split('/')
+        body = self._read_body()
+        if path[-1] == '_bulk':
+            lines = [line for line in body.splitlines() if line.strip()]
+            items = []
+            i = 0
+            while i < len(lines):
+                action, meta = next(iter(json.loads(lines[i]).items()))
+                items.append({action: {
+                    '_index': meta.get('_index'), '_id': meta.get('_id'), 'status': 201, 'result': 'created',
+                }})
+                # delete actions have no source line
+                i += 1 if action == 'delete' else 2
+            self.server.documents += len(items)
+            self.server.bytes += len(body)
+            self._send(200, {'took': 0, 'errors': False, 'items': items})
+        else:
+            self.server.documents += 1
+            self.server.bytes += len(body)
+            self._send(201, {
+                '_index': path[0], '_id': path[-1] if len(path) > 2 else 'generated', '_version': 1,
+                'result': 'created', '_seq_no': 0, '_primary_term': 1,
+            })
+
+    do_POST = do_PUT
+
+
+class FakeElasticsearch:
+    """
+    Fake Elasticsearch HTTP server running in a background thread.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self.server = ThreadingHTTPServer((host, port), FakeElasticsearchHandler)
+        self.server.documents = 0
+        self.server.bytes = 0
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address
+        return f'http://{host}:{port}'
+
+    @property
+    def documents(self) -> int:
+        return self.server.documents
+
+    @property
+    def bytes(self) -> int:
+        return self.server.bytes
+
+    def reset(self) -> None:
+        self.server.documents = 0
+        self.server.bytes = 0
+
+    def __enter__(self) -> 'FakeElasticsearch':
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.server.shutdown()
+        self.server.server_close()
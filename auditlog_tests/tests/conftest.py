@@ -6,7 +6,10 @@ from sqlalchemy import create_engine, event
 from sqlalchemy.engine.base import Connection
 from sqlalchemy.orm import sessionmaker
 
+from auditlog.documents import LogEntry
 from auditlog.receivers import save_log_entries_after_commit, track_instances_after_flush
+from auditlog.session import AuditlogSession
+from auditlog.sinks import MemorySink, set_sink
 from auditlog_tests import test_conf
 from auditlog_tests.models import Base
 
@@ -15,7 +18,7 @@ engine = create_engine(
     f'{test_conf.POSTGRES_PORT}/{test_conf.POSTGRES_DB}_test',
     pool_pre_ping=True
 )
-TestSession = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+TestSession = sessionmaker(class_=AuditlogSession, autocommit=False, autoflush=False, bind=engine)
 
 event.listen(TestSession, "after_flush", track_instances_after_flush)
 event.listen(TestSession, "after_commit", save_log_entries_after_commit)
@@ -52,6 +55,17 @@ def db(connection: Connection) -> Generator:
 
 
 @pytest.fixture(scope="function", autouse=True)
-def mock_save():
-    with patch('auditlog.documents.LogEntry.log_create') as mock:
+def sink() -> MemorySink:
+    sink = MemorySink()
+    set_sink(sink)
+    try:
+        yield sink
+    finally:
+        set_sink(None)
+
+
+@pytest.fixture(scope="function", autouse=True)
+def mock_save(sink: MemorySink):
+    # Entries are still built and written to the memory sink, the mock records the arguments
+    with patch('auditlog.documents.LogEntry.log_create', wraps=LogEntry.log_create) as mock:
         yield mock
@@ -1,13 +1,33 @@
 import datetime
-from typing import Any
+import gzip
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
+from unittest.mock import Mock, patch
 
 import pytest
+from elasticsearch.exceptions import ConflictError
+from elasticsearch.serializer import JSONSerializer
 from sqlalchemy import inspect
 from sqlalchemy.orm import Session
 
-from auditlog.context import set_user, set_remote_addr, remove_remote_addr
+from auditlog import conf, rollup, sinks
+from auditlog.blobs import (
+    Blob, BlobStore, FileSystemBlobStore, set_blob_store, externalize_changes, resolve_value, PREVIEW,
+)
+from auditlog.compact import (
+    FileSystemSchemaStore, MemorySchemaStore, decode_changes, encode_changes, encode_entry, set_schema_store,
+)
+from auditlog.context import set_user, set_remote_addr, remove_remote_addr, set_tenant, remove_tenant
 from auditlog.documents import LogEntry
+from auditlog.export import NDJSONPartitionWriter, PartitionWriter, build_query
+from auditlog.history import HistoryCache, set_history_cache, get_object_history
+from auditlog.metrics import AuditlogMetrics, set_metrics
 from auditlog.registry import auditlog
+from auditlog.rollup import ActivityRollup, ActivityRollupCounter, get_bucket
+from auditlog.routing import Route, get_index_template, get_route, search, set_tenant_resolver, default_tenant_resolver
+from auditlog.sinks import ElasticsearchSink, MemorySink, NDJSONFileSink, set_sink
 from auditlog_tests import models
 
 
@@ -298,3 +318,762 @@ class TestCustomLogEntry:
         assert mock_save.call_count == 1
         kwargs = mock_save.call_args.args[0]
         assert kwargs['text'] == 'custom text'
+
+
+class TestDocumentId:
+    def test_entries_are_bound_to_transaction(self, db: Session, mock_save):
+        db.add(models.SimpleModel(text='first'))
+        db.add(models.SimpleModel(text='second'))
+        db.commit()
+        assert mock_save.call_count == 2
+        first, second = (call.args[0] for call in mock_save.call_args_list)
+        assert first['transaction_id'] == second['transaction_id']
+        assert {first['sequence'], second['sequence']} == {0, 1}
+
+    def test_document_id_is_deterministic(self, db: Session, mock_save):
+        obj = models.SimpleModel(text='text')
+        db.add(obj)
+        db.commit()
+        kwargs = mock_save.call_args.args[0]
+        # A retry builds the entry again from the same values
+        retried = {name: kwargs[name] for name in ('transaction_id', 'table_name', 'object_pk', 'action', 'sequence')}
+        document_id = LogEntry.get_document_id(kwargs)
+        assert document_id is not None
+        assert document_id == LogEntry.get_document_id(retried)
+        assert document_id != LogEntry.get_document_id(dict(retried, sequence=kwargs['sequence'] + 1))
+        assert document_id != LogEntry.get_document_id(dict(retried, transaction_id='other'))
+
+    def test_document_id_without_transaction(self):
+        assert LogEntry.get_document_id({'table_name': 'simple_model'}) is None
+
+    @pytest.fixture(scope="function")
+    def metrics(self):
+        metrics = TestMetrics.RecordingMetrics()
+        set_metrics(metrics)
+        yield metrics
+        set_metrics(AuditlogMetrics())
+
+    @pytest.fixture(scope="function")
+    def client(self):
+        client = Mock()
+        client.transport.serializer = JSONSerializer()
+        return client
+
+    @staticmethod
+    def make_entry(sequence: int) -> LogEntry:
+        kwargs = {
+            'action': LogEntry.Action.CREATE, 'table_name': 'simple_model', 'object_pk': '1',
+            'timestamp': datetime.datetime.now(), 'transaction_id': 'abc', 'sequence': sequence,
+        }
+        return LogEntry(meta={'id': LogEntry.get_document_id(kwargs)}, **kwargs)
+
+    def test_save_conflict(self, client: Mock, metrics: AuditlogMetrics):
+        client.index.side_effect = ConflictError(409, 'version_conflict_engine_exception', {})
+        log_entry = self.make_entry(0)
+        assert log_entry.save(using=client) == 'noop'
+        assert client.index.call_args.kwargs['op_type'] == 'create'
+        assert client.index.call_args.kwargs['id'] == log_entry.meta.id
+        assert metrics.saved == [log_entry]
+        assert metrics.failed == []
+
+    def test_bulk_conflict(self, client: Mock, metrics: AuditlogMetrics, monkeypatch):
+        client.bulk.return_value = {'errors': True, 'items': [
+            {'create': {'status': 409, 'error': {'type': 'version_conflict_engine_exception'}}},
+            {'create': {'status': 201}},
+            {'create': {'status': 400, 'error': {'type': 'mapper_parsing_exception'}}},
+        ]}
+        monkeypatch.setattr(sinks.connections, 'get_connection', lambda alias='default': client)
+        log_entries = [self.make_entry(sequence) for sequence in range(3)]
+        ElasticsearchSink().write_many(log_entries)
+        body = client.bulk.call_args.kwargs['body']
+        assert json.loads(body.splitlines()[0]) == {'create': {'_id': log_entries[0].meta.id}}
+        assert metrics.saved == log_entries[:2]
+        assert metrics.sizes == [len(line.encode('utf-8')) for line in body.splitlines()[1:4:2]]
+        assert metrics.failed == log_entries[2:]
+
+
+class TestBlobStore:
+    @pytest.fixture(scope="function")
+    def blob_store(self, tmp_path):
+        store = FileSystemBlobStore(str(tmp_path))
+        set_blob_store(store)
+        yield store
+        set_blob_store(None)
+
+    def test_externalize_large_values(self, blob_store: FileSystemBlobStore):
+        large = 'x' * 1000
+        changes = [{'field': 'text', 'old': 'small', 'new': large}]
+        externalized = externalize_changes(changes, threshold=100)
+        change = externalized[0]
+        assert changes[0]['new'] == large
+        assert change['old'] == 'small'
+        assert 'old_hash' not in change
+        assert change['new'] == large[:PREVIEW]
+        assert change['new_size'] == 1000
+        assert change['new_hash'] == FileSystemBlobStore.make_key(large.encode())
+        assert resolve_value(change, 'new') == large
+        assert resolve_value(change, 'old') == 'small'
+
+    def test_values_are_deduplicated(self, blob_store: FileSystemBlobStore, tmp_path):
+        large = 'y' * 1000
+        changes = [{'field': 'text', 'old': large, 'new': large}]
+        change = externalize_changes(changes, threshold=100)[0]
+        assert change['old_hash'] == change['new_hash']
+        assert len(list(tmp_path.rglob('*'))) == 2  # one directory, one file
+
+    def test_content_is_not_indexed(self):
+        mapping = Blob._doc_type.mapping.to_dict()['properties']
+        assert mapping['content'] == {'type': 'binary'}
+        with pytest.raises(TypeError):
+            BlobStore()
+
+
+class TestMetrics:
+    class RecordingMetrics(AuditlogMetrics):
+        def __init__(self):
+            self.flushes = []
+            self.captured = []
+            self.shipped = []
+            self.saved = []
+            self.sizes = []
+            self.failed = []
+
+        def flush_processed(self, duration: float, entries: int) -> None:
+            self.flushes.append(entries)
+
+        def entry_captured(self, table_name: str, action: str) -> None:
+            self.captured.append((table_name, action))
+
+        def entries_shipped(self, duration: float, count: int) -> None:
+            self.shipped.append(count)
+
+        def entry_saved(self, log_entry: Any, size: Optional[int] = None) -> None:
+            self.saved.append(log_entry)
+            self.sizes.append(size)
+
+        def entry_failed(self, log_entry: Any) -> None:
+            self.failed.append(log_entry)
+
+    @pytest.fixture(scope="function")
+    def metrics(self):
+        metrics = self.RecordingMetrics()
+        set_metrics(metrics)
+        yield metrics
+        set_metrics(AuditlogMetrics())
+
+    def test_hooks(self, db: Session, metrics: RecordingMetrics, mock_save):
+        db.add(models.SimpleModel(text='first'))
+        db.add(models.SimpleModel(text='second'))
+        db.commit()
+        assert metrics.flushes == [2]
+        assert metrics.captured == [(models.SimpleModel.__tablename__, LogEntry.Action.CREATE)] * 2
+        assert metrics.shipped == [2]
+        assert len(metrics.saved) == 2
+
+    def test_entry_size(self, db: Session, metrics: RecordingMetrics, tmp_path):
+        path = tmp_path / 'entries.ndjson'
+        set_sink(NDJSONFileSink(str(path)))
+        db.add(models.SimpleModel(text='text'))
+        db.commit()
+        source = path.read_text().splitlines()[1]
+        assert metrics.sizes == [len(source.encode('utf-8'))]
+
+
+class TestSinks:
+    @staticmethod
+    def make_entry(**kwargs) -> LogEntry:
+        kwargs.setdefault('action', LogEntry.Action.CREATE)
+        kwargs.setdefault('timestamp', datetime.datetime.now())
+        return LogEntry(meta={'id': kwargs.pop('id', None)}, **kwargs)
+
+    def test_memory_sink(self):
+        sink = MemorySink(size=2)
+        sink.write(self.make_entry(table_name='first'))
+        sink.write(self.make_entry(table_name='second', action=LogEntry.Action.DELETE))
+        sink.write(self.make_entry(table_name='third'))
+        assert [entry.table_name for entry in sink.entries] == ['second', 'third']
+        assert [entry.table_name for entry in sink.filter(action=LogEntry.Action.CREATE)] == ['third']
+        sink.clear()
+        assert sink.entries == []
+
+    def test_batch(self):
+        sink = MemorySink()
+        with sink.batch():
+            sink.write(self.make_entry(table_name='first'))
+            with sink.batch():
+                sink.write(self.make_entry(table_name='second'))
+            assert sink.entries == []
+        assert len(sink.entries) == 2
+
+    def test_sink_is_abstract(self):
+        with pytest.raises(TypeError):
+            sinks.Sink()
+
+    def test_ndjson_file_sink(self, tmp_path):
+        path = tmp_path / 'entries.ndjson'
+        sink = NDJSONFileSink(str(path))
+        sink.write(self.make_entry(table_name='first', id='abc'))
+        sink.write(self.make_entry(table_name='second'))
+        lines = [json.loads(line) for line in path.read_text().splitlines()]
+        assert lines[0] == {'create': {'_index': LogEntry._index._name, '_id': 'abc'}}
+        assert lines[1]['table_name'] == 'first'
+        assert '_id' not in lines[2]['create']
+        assert lines[3]['table_name'] == 'second'
+
+    def test_commit_to_ndjson_file_sink(self, db: Session, tmp_path):
+        path = tmp_path / 'entries.ndjson'
+        set_sink(NDJSONFileSink(str(path)))
+        obj = models.SimpleModel(text='text')
+        db.add(obj)
+        db.commit()
+        action, source = [json.loads(line) for line in path.read_text().splitlines()]
+        assert action['create']['_id'] == LogEntry.get_document_id(source)
+        assert source['table_name'] == models.SimpleModel.__tablename__
+        assert source['object_pk'] == str(obj.id)
+        assert {'field': 'text', 'new': 'text'} in source['changes']
+
+    def test_invalid_entries_are_not_raised(self):
+        metrics = TestMetrics.RecordingMetrics()
+        set_metrics(metrics)
+        try:
+            # `timestamp` is required, the entries fail validation before anything is sent
+            ElasticsearchSink().write_many([
+                LogEntry(action=LogEntry.Action.CREATE, table_name='first'),
+                LogEntry(action=LogEntry.Action.CREATE, table_name='second'),
+            ])
+        finally:
+            set_metrics(AuditlogMetrics())
+        assert [log_entry.table_name for log_entry in metrics.failed] == ['first', 'second']
+
+
+class TestActivityRollup:
+    def test_record(self):
+        counter = ActivityRollupCounter(interval=3600)
+        timestamp = datetime.datetime(2021, 1, 1, 10, 30)
+        counter.record([
+            {'table_name': 'simple_model', 'action': LogEntry.Action.CREATE, 'timestamp': timestamp, 'actor_id': 1},
+            {'table_name': 'simple_model', 'action': LogEntry.Action.CREATE, 'timestamp': timestamp, 'actor_id': 1},
+            {'table_name': 'simple_model', 'action': LogEntry.Action.UPDATE, 'timestamp': timestamp},
+        ])
+        bucket = datetime.datetime(2021, 1, 1, 10)
+        assert counter.counts == {
+            ('simple_model', LogEntry.Action.CREATE, '1', bucket): 2,
+            ('simple_model', LogEntry.Action.UPDATE, None, bucket): 1,
+        }
+
+    def test_background_flush(self):
+        saved = []
+
+        class RecordingCounter(ActivityRollupCounter):
+            def _save(self, counts):
+                saved.append(counts)
+
+        counter = RecordingCounter(interval=0.01)
+        counter.record([{'table_name': 'simple_model', 'action': LogEntry.Action.CREATE,
+                         'timestamp': datetime.datetime(2021, 1, 1, 10, 30)}])
+        assert saved == []
+        counter.start()
+        counter.stop()
+        assert sum(counts[key] for counts in saved for key in counts) == 1
+        assert counter.counts == {}
+
+    def test_requires_elasticsearch_sink(self, monkeypatch):
+        monkeypatch.setattr(conf, 'ROLLUP_INTERVAL', 60)
+        monkeypatch.setattr(conf, 'SINK', 'memory')
+        monkeypatch.setattr(rollup, '_disabled', False)
+        assert rollup.get_counter() is None
+
+    def test_make_id(self):
+        bucket = datetime.datetime(2021, 1, 1, 10)
+        key = ('simple_model', LogEntry.Action.CREATE, '1', bucket)
+        assert ActivityRollup.make_id(key) == ActivityRollup.make_id(
+            ('simple_model', LogEntry.Action.CREATE, '1', get_bucket(datetime.datetime(2021, 1, 1, 10, 59)))
+        )
+        assert ActivityRollup.make_id(key) != ActivityRollup.make_id(key[:3] + (bucket.replace(hour=11),))
+        assert ActivityRollup.make_id(key) != ActivityRollup.make_id(key[:2] + ('2', bucket))
+        assert ActivityRollup.make_id(key) != ActivityRollup.make_id(key[:2] + (None, bucket))
+
+    def test_mapping(self):
+        properties = ActivityRollup._doc_type.mapping.to_dict()['properties']
+        assert {properties[name]['type'] for name in ('table_name', 'action', 'actor_id')} == {'keyword'}
+
+
+class TestBulkOperations:
+    def test_bulk_insert_mappings(self, db: Session, mock_save):
+        db.bulk_insert_mappings(models.SimpleModel, [
+            {'id': 1000 + i, 'text': f'bulk {i}'} for i in range(3)
+        ])
+        db.commit()
+        assert mock_save.call_count == 3
+        kwargs = mock_save.call_args.args[0]
+        assert kwargs['action'] == LogEntry.Action.CREATE
+        assert kwargs['object_pk'] == '1002'
+        assert kwargs['table_name'] == models.SimpleModel.__tablename__
+        assert {'field': 'text', 'old': None, 'new': 'bulk 2'} in kwargs['changes']
+
+    def test_bulk_insert_mappings_generated_pk(self, db: Session, mock_save):
+        mappings = [{'text': 'generated'}, {'text': 'generated'}]
+        with patch.object(Session, 'bulk_insert_mappings', autospec=True,
+                          side_effect=Session.bulk_insert_mappings) as insert:
+            db.bulk_insert_mappings(models.SimpleModel, mappings)
+        db.commit()
+        # Keys are allocated in advance, rows are not inserted one by one to return them
+        assert insert.call_args.args[3] is False
+        assert mappings[0]['id'] != mappings[1]['id']
+        kwargs = mock_save.call_args.args[0]
+        assert kwargs['object_pk'] == str(mappings[1]['id'])
+        assert kwargs['object_id'] == mappings[1]['id']
+        assert db.query(models.SimpleModel).filter_by(id=mappings[1]['id']).one().text == 'generated'
+
+    def test_bulk_update_mappings(self, db: Session, mock_save):
+        obj = models.SimpleModel(text='text')
+        db.add(obj)
+        db.commit()
+        db.bulk_update_mappings(models.SimpleModel, [{'id': obj.id, 'text': 'bulk'}])
+        db.commit()
+        assert mock_save.call_count == 2
+        kwargs = mock_save.call_args.args[0]
+        assert kwargs['action'] == LogEntry.Action.UPDATE
+        assert kwargs['object_pk'] == str(obj.id)
+        assert kwargs['changes'] == [{'field': 'text', 'old': None, 'new': 'bulk'}]
+
+    def test_bulk_include_fields(self, db: Session, mock_save):
+        db.bulk_insert_mappings(models.SimpleIncludeModel, [{'id': 1000, 'label': 'label', 'text': 'text'}])
+        db.commit()
+        assert mock_save.call_args.args[0]['changes'] == [{'field': 'label', 'old': None, 'new': 'label'}]
+
+    def test_bulk_save_objects(self, db: Session, mock_save):
+        db.bulk_save_objects([models.SimpleModel(text='first'), models.SimpleModel(text='second')])
+        db.commit()
+        assert mock_save.call_count == 2
+        kwargs = mock_save.call_args.args[0]
+        assert kwargs['action'] == LogEntry.Action.CREATE
+        assert kwargs['changes'] == [{'field': 'text', 'old': None, 'new': 'second'}]
+
+    def test_bulk_save_objects_generated_pk(self, db: Session, mock_save):
+        obj = models.SimpleModel(text='generated')
+        db.bulk_save_objects([obj])
+        db.commit()
+        kwargs = mock_save.call_args.args[0]
+        assert obj.id is not None
+        assert kwargs['object_pk'] == str(obj.id)
+        assert kwargs['object_id'] == obj.id
+
+    def test_unregistered(self, db: Session, mock_save):
+        db.bulk_insert_mappings(models.SimpleIncludeModel, [])
+        db.bulk_insert_mappings(models.RelatedModel.__mapper__, [{'id': 1000}])
+        auditlog.unregister(models.RelatedModel)
+        try:
+            db.bulk_insert_mappings(models.RelatedModel, [{'id': 1001}])
+        finally:
+            auditlog.register(models.RelatedModel)
+        db.commit()
+        assert mock_save.call_count == 1
+
+
+class TestRelationshipFields:
+    @pytest.fixture(scope="function", autouse=True)
+    def track_relationships(self):
+        auditlog.register(models.ManyRelatedModel, relationship_fields=['models'])
+        yield
+        auditlog.register(models.ManyRelatedModel)
+
+    @pytest.fixture(scope="function")
+    def obj(self, db: Session) -> models.ManyRelatedModel:
+        simple = models.SimpleModel(text='simple')
+        db.add(simple)
+        db.flush()
+        obj = models.ManyRelatedModel(text='related')
+        obj.models.append(simple)
+        db.add(obj)
+        db.commit()
+        db.refresh(obj)
+        return obj
+
+    def test_added(self, obj: models.ManyRelatedModel, mock_save):
+        kwargs = mock_save.call_args.args[0]
+        assert kwargs['table_name'] == models.ManyRelatedModel.__tablename__
+        assert {'field': 'models', 'added': [str(obj.models[0].id)], 'removed': []} in kwargs['changes']
+
+    def test_removed(self, db: Session, obj: models.ManyRelatedModel, mock_save):
+        simple = obj.models[0]
+        obj.models.remove(simple)
+        db.commit()
+        assert mock_save.call_count == 3
+        kwargs = mock_save.call_args.args[0]
+        assert kwargs['changes'] == [{'field': 'models', 'added': [], 'removed': [str(simple.id)]}]
+
+    def test_collection_is_not_loaded(self, db: Session, obj: models.ManyRelatedModel, mock_save):
+        obj.text = 'changed'
+        db.commit()
+        assert mock_save.call_count == 3
+        assert mock_save.call_args.args[0]['changes'] == [{'field': 'text', 'old': 'related', 'new': 'changed'}]
+        assert 'models' not in inspect(obj).dict
+
+
+class TestCompactEncoding:
+    FIELDS = ('text', 'boolean', 'models')
+
+    @pytest.fixture(scope="function", autouse=True)
+    def compact(self):
+        store = MemorySchemaStore()
+        set_schema_store(store)
+        auditlog.register(models.SimpleModel, compact=True)
+        yield store
+        auditlog.register(models.SimpleModel)
+        set_schema_store(None)
+
+    def test_round_trip(self):
+        changes = [
+            {'field': 'text', 'old': None, 'new': 'żółw'},
+            {'field': 'models', 'added': ['1', '2'], 'removed': []},
+        ]
+        packed = encode_changes(changes, self.FIELDS)
+        assert decode_changes(packed, self.FIELDS) == changes
+
+    def test_externalized_value(self):
+        changes = [{'field': 'boolean', 'old': 'a' * PREVIEW, 'old_hash': 'abc', 'old_size': 1000, 'new': 'b'}]
+        assert decode_changes(encode_changes(changes, self.FIELDS), self.FIELDS) == changes
+
+    def test_unknown_field(self):
+        with pytest.raises(ValueError):
+            encode_changes([{'field': 'other', 'old': None, 'new': '1'}], self.FIELDS)
+
+    def test_schema_version(self, db: Session, mock_save):
+        db.add(models.SimpleModel(text='text'))
+        db.commit()
+        kwargs = mock_save.call_args.args[0]
+        plan = auditlog.get_audit_plan(models.SimpleModel)
+        assert kwargs['schema_version'] == plan.schema_version
+        assert auditlog.get_schema(plan.schema_version) == plan.fields
+
+    def test_log_entry(self, db: Session, mock_save):
+        obj = models.SimpleModel(text='text')
+        db.add(obj)
+        db.commit()
+        obj.text = 'changed'
+        db.commit()
+        kwargs = mock_save.call_args.args[0]
+        log_entry = LogEntry(**encode_entry(kwargs))
+        assert 'changes' not in log_entry.to_dict()
+        assert log_entry.change_fields == ['text']
+        assert log_entry.changed_fields == '1 change: text'
+        assert log_entry.get_changes() == kwargs['changes']
+
+    def test_changed_registration(self, db: Session, compact: MemorySchemaStore, sink: MemorySink):
+        db.add(models.SimpleModel(text='text', integer=1))
+        db.commit()
+        source = sink.entries[-1].to_dict()
+        auditlog.register(models.SimpleModel, compact=True, exclude_fields=['integer'])
+        # A restarted process knows only the schemas of the current registrations
+        auditlog._schemas.clear()
+        log_entry = LogEntry.from_es({'_id': 'id', '_source': source})
+        assert log_entry.schema_version != auditlog.get_audit_plan(models.SimpleModel).schema_version
+        assert {'field': 'integer', 'old': None, 'new': '1'} in log_entry.get_changes()
+
+    def test_schema_store_failure(self, db: Session, sink: MemorySink):
+        class FailingSchemaStore(MemorySchemaStore):
+            def _put(self, version, fields):
+                raise ConnectionError()
+
+        set_schema_store(FailingSchemaStore())
+        db.add(models.SimpleModel(text='text'))
+        db.commit()
+        log_entry = sink.entries[-1]
+        assert log_entry.schema_version is None
+        assert {'field': 'text', 'old': None, 'new': 'text'} in log_entry.get_changes()
+
+    def test_filesystem_schema_store(self, tmp_path):
+        store = FileSystemSchemaStore(str(tmp_path))
+        store.put('abc', self.FIELDS)
+        assert FileSystemSchemaStore(str(tmp_path)).get('abc') == self.FIELDS
+        assert store.get('other') is None
+
+    def test_ndjson_export(self, db: Session, sink: MemorySink, tmp_path):
+        db.add(models.SimpleModel(text='text'))
+        db.commit()
+        entry = sink.entries[-1]
+        with NDJSONPartitionWriter(str(tmp_path)) as writer:
+            writer.write({'_id': entry.meta.id, '_source': json.loads(JSONSerializer().dumps(entry.to_dict()))})
+        path, = tmp_path.rglob('*.ndjson.gz')
+        with gzip.open(path, 'rt') as f:
+            source = json.loads(f.read())
+        assert source['changes'] == [{'field': 'text', 'old': None, 'new': 'text'}]
+        assert 'changes_packed' not in source and 'schema_version' not in source
+
+    def test_history_cache(self, db: Session, sink: MemorySink):
+        cache = HistoryCache(maxsize=2, ttl=60)
+        set_history_cache(cache)
+        try:
+            obj = models.SimpleModel(text='text')
+            db.add(obj)
+            db.commit()
+            db.refresh(obj)
+            key = (None, models.SimpleModel.__tablename__, str(obj.id))
+            cache.set(key, [], 20)
+            obj.text = 'changed'
+            db.commit()
+            entries = get_object_history(models.SimpleModel, obj.id)
+        finally:
+            set_history_cache(None)
+        assert entries[0].changed_fields == '1 change: text'
+        assert entries[0].get_changes() == sink.entries[-1].get_changes() == [
+            {'field': 'text', 'old': 'text', 'new': 'changed'}
+        ]
+
+
+class TestExport:
+    def test_ndjson_partitions(self, tmp_path):
+        hits = [
+            {'_id': str(i), '_source': {'table_name': f'table_{i % 2}', 'timestamp': f'2021-01-0{i // 2 + 1}T10:00:00'}}
+            for i in range(4)
+        ]
+        with NDJSONPartitionWriter(str(tmp_path), max_open=1) as writer:
+            for hit in hits:
+                writer.write(hit)
+
+        path = tmp_path / 'table_name=table_0' / 'date=2021-01-01' / 'part-00000.ndjson.gz'
+        with gzip.open(path, 'rt') as f:
+            assert [json.loads(line)['id'] for line in f] == ['0']
+        assert len(list(tmp_path.rglob('*.ndjson.gz'))) == 4
+
+    def test_reopened_partition(self, tmp_path):
+        with NDJSONPartitionWriter(str(tmp_path), max_open=1) as writer:
+            for i, table_name in enumerate(['first', 'second', 'first']):
+                writer.write({'_id': str(i), '_source': {'table_name': table_name, 'timestamp': '2021-01-01'}})
+
+        path = tmp_path / 'table_name=first' / 'date=2021-01-01' / 'part-00000.ndjson.gz'
+        with gzip.open(path, 'rt') as f:
+            assert [json.loads(line)['id'] for line in f] == ['0', '2']
+
+    def test_writer_is_abstract(self, tmp_path):
+        with pytest.raises(TypeError):
+            PartitionWriter(str(tmp_path))
+
+    def test_build_query(self):
+        since = datetime.datetime(2021, 1, 1)
+        assert build_query(since=since, tables=['user']) == {'bool': {'filter': [
+            {'range': {'timestamp': {'gte': since.isoformat()}}},
+            {'terms': {'table_name': ['user']}},
+        ]}}
+
+
+class TestSubscriptions:
+    @pytest.fixture(scope="function")
+    def events(self):
+        events = []
+
+        def callback(batch):
+            events.append(batch)
+
+        auditlog.subscribe(models.SimpleModel, callback, fields=['boolean'])
+        yield events
+        auditlog.unsubscribe(models.SimpleModel, callback)
+
+    def test_batched_events(self, db: Session, events: list, mock_save):
+        db.add(models.SimpleModel(text='first'))
+        db.add(models.SimpleModel(text='second'))
+        db.commit()
+        assert len(events) == 1
+        assert [event.action for event in events[0]] == [LogEntry.Action.CREATE] * 2
+
+    def test_fields(self, db: Session, events: list, mock_save):
+        obj = models.SimpleModel(text='text', boolean=False)
+        db.add(obj)
+        db.commit()
+        obj.text = 'changed'
+        db.commit()
+        assert len(events) == 1
+        obj.boolean = True
+        db.commit()
+        assert len(events) == 2
+        event = events[1][0]
+        assert event.action == LogEntry.Action.UPDATE
+        assert event.object_pk == str(obj.id)
+        assert event.fields == ['boolean']
+
+    def test_shared_table(self, db: Session, events: list, mock_save):
+        polymorphic_events = []
+        auditlog.subscribe(models.PolymorphicModel, polymorphic_events.append)
+        try:
+            db.add(models.SimpleModel(text='simple'))
+            db.add(models.PolymorphicModel(text='polymorphic'))
+            db.commit()
+        finally:
+            auditlog.unsubscribe(models.PolymorphicModel, polymorphic_events.append)
+        assert [event.entry['_model'] for event in events[0]] == [models.SimpleModel]
+        assert [event.entry['_model'] for event in polymorphic_events[0]] == [models.PolymorphicModel]
+        assert all('_model' not in entry.to_dict() for entry in sinks.get_sink().entries)
+
+    def test_executor(self, db: Session, mock_save):
+        events = []
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            auditlog.subscribe(models.SimpleModel, events.append, executor=executor)
+            try:
+                db.add(models.SimpleModel(text='text'))
+                db.commit()
+            finally:
+                auditlog.unsubscribe(models.SimpleModel, events.append)
+        assert len(events) == 1
+
+
+class TestHistoryCache:
+    @pytest.fixture(scope="function")
+    def cache(self):
+        cache = HistoryCache(maxsize=2, ttl=60)
+        set_history_cache(cache)
+        yield cache
+        set_history_cache(None)
+
+    def test_lookup(self, cache: HistoryCache):
+        key = (None, 'simple_model', '1')
+        assert cache.get(key, 20) is None
+        cache.set(key, ['second', 'first'], 2)
+        assert cache.get(key, 1) == ['second']
+        assert cache.get(key, 20) is None  # more entries may exist
+        assert cache.get(('tenant', 'simple_model', '1'), 1) is None
+        assert cache.stats == {'hits': 1, 'misses': 3, 'hit_ratio': 1 / 4, 'size': 1}
+
+    def test_complete_history(self, cache: HistoryCache):
+        key = (None, 'simple_model', '1')
+        cache.set(key, ['first'], 20)
+        assert cache.get(key, 50) == ['first']
+
+    def test_lru(self, cache: HistoryCache):
+        for pk in ('1', '2', '3'):
+            cache.set((None, 'simple_model', pk), [], 20)
+        assert (None, 'simple_model', '1') not in cache
+        assert (None, 'simple_model', '3') in cache
+
+    def test_ttl(self, cache: HistoryCache):
+        cache.ttl = -1
+        cache.set((None, 'simple_model', '1'), [], 20)
+        assert cache.get((None, 'simple_model', '1'), 20) is None
+
+    def test_committed_entries(self, db: Session, cache: HistoryCache, mock_save):
+        obj = models.SimpleModel(text='text')
+        db.add(obj)
+        db.commit()
+        key = (None, models.SimpleModel.__tablename__, str(obj.id))
+        cache.set(key, [], 20)
+        obj.text = 'changed'
+        db.commit()
+        entries = cache.get(key, 20)
+        assert len(entries) == 1
+        assert entries[0].action == LogEntry.Action.UPDATE
+        assert get_object_history(models.SimpleModel, obj.id) == entries
+
+    def test_failed_entries(self, db: Session, cache: HistoryCache):
+        class FailingSink(MemorySink):
+            def write_many(self, log_entries):
+                return []
+
+        obj = models.SimpleModel(text='text')
+        db.add(obj)
+        db.commit()
+        key = (None, models.SimpleModel.__tablename__, str(obj.id))
+        cache.set(key, [], 20)
+        set_sink(FailingSink())
+        obj.text = 'changed'
+        db.commit()
+        assert cache.get(key, 20) == []
+
+    def test_cached_entries_are_stored_entries(
+        self, db: Session, cache: HistoryCache, sink: MemorySink, monkeypatch, tmp_path
+    ):
+        set_blob_store(FileSystemBlobStore(str(tmp_path)))
+        monkeypatch.setattr(conf, 'BLOB_THRESHOLD', 100)
+        try:
+            obj = models.SimpleModel(text='text')
+            db.add(obj)
+            db.commit()
+            key = (None, models.SimpleModel.__tablename__, str(obj.id))
+            cache.set(key, [], 20)
+            obj.text = 'x' * 1000
+            db.commit()
+        finally:
+            set_blob_store(None)
+        entry = cache.get(key, 20)[0]
+        assert entry is sink.entries[-1]
+        change = entry.get_changes()[0]
+        assert change['new'] == 'x' * PREVIEW
+        assert change['new_size'] == 1000
+
+
+class TestFlushGrouping:
+    def test_mixed_models(self, db: Session, mock_save):
+        auditlog.unregister(models.SimpleIncludeModel)
+        try:
+            db.add(models.SimpleModel(text='first'))
+            db.add(models.SimpleIncludeModel(label='unregistered'))
+            db.add(models.ManyRelatedModel(text='many'))
+            db.add(models.SimpleModel(text='second'))
+            db.commit()
+        finally:
+            auditlog.register(models.SimpleIncludeModel, include_fields=['label'])
+        assert mock_save.call_count == 3
+        entries = [call.args[0] for call in mock_save.call_args_list]
+        assert sorted(kwargs['table_name'] for kwargs in entries) == [
+            models.ManyRelatedModel.__tablename__, models.SimpleModel.__tablename__, models.SimpleModel.__tablename__,
+        ]
+        assert len({kwargs['timestamp'] for kwargs in entries}) == 1
+
+    def test_audit_plan(self):
+        plan = auditlog.get_audit_plan(models.SimpleIncludeModel)
+        assert plan.columns == ('label',)
+        assert 'label' not in auditlog.get_audit_plan(models.SimpleExcludeModel).columns
+
+
+class TestTenantRouting:
+    TENANT = 'acme'
+
+    @pytest.fixture(scope="function")
+    def tenant(self):
+        token = set_tenant(self.TENANT)
+        yield self.TENANT
+        remove_tenant(token)
+
+    def test_tenant_field(self, db: Session, tenant: str, mock_save):
+        db.add(models.SimpleModel(text='text'))
+        db.commit()
+        assert mock_save.call_args.args[0]['tenant'] == tenant
+
+    def test_tenant_resolver(self, db: Session, mock_save):
+        set_tenant_resolver(lambda instance: getattr(instance, 'text', None))
+        try:
+            db.add(models.SimpleModel(text='from instance'))
+            db.commit()
+        finally:
+            set_tenant_resolver(default_tenant_resolver)
+        assert mock_save.call_args.args[0]['tenant'] == 'from instance'
+
+    def test_index_routing(self, monkeypatch, tenant: str):
+        monkeypatch.setattr(conf, 'TENANT_ROUTING', 'index')
+        assert get_route(tenant) == Route(f'{conf.INDEX_NAME}-tenant-{tenant}')
+        assert get_route(None) == Route(conf.INDEX_NAME)
+        assert search()._index == [f'{conf.INDEX_NAME}-tenant-{tenant}']
+        assert search().to_dict() == {'query': {'bool': {'filter': [{'term': {'tenant': tenant}}]}}}
+
+    def test_tenant_index_name(self, monkeypatch):
+        monkeypatch.setattr(conf, 'TENANT_ROUTING', 'index')
+        assert get_route('acme-2').index == f'{conf.INDEX_NAME}-tenant-acme-2'
+        index = get_route('Acme Corp/EU*').index
+        assert re.fullmatch(rf'{conf.INDEX_NAME}-tenant-acme_corp_eu_-[0-9a-f]{{8}}', index)
+        assert get_route('acme corp/eu*').index != index
+        assert len(get_route('x' * 1000).index) < 255
+
+    def test_index_template(self):
+        template = get_index_template().to_dict()
+        assert template['index_patterns'] == [f'{conf.INDEX_NAME}-tenant-*']
+        properties = template['mappings']['properties']
+        assert properties['changes']['type'] == 'nested'
+        assert properties['tenant'] == {'type': 'keyword'}
+        assert properties['object_pk'] == {'type': 'keyword'}
+
+    def test_shard_routing(self, monkeypatch, tenant: str):
+        monkeypatch.setattr(conf, 'TENANT_ROUTING', 'routing')
+        assert get_route(tenant) == Route(conf.INDEX_NAME, tenant)
+        assert search()._params == {'routing': tenant}
+
+    def test_no_routing(self, tenant: str):
+        assert get_route(tenant) == Route(conf.INDEX_NAME)